@@ -1,19 +1,34 @@
 from fastapi import FastAPI
 from . import routes
 from .config import  config
-import logging, datetime
+import logging, logging.handlers, datetime, queue, copy
 
 class BroadcastFilter(logging.Filter):
+    def filter(self, record):
+        return config.should_broadcast_logger(record.name)
+
+class BroadcastQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # only the message is broadcast, a traceback stays in the log output instead of being sent to every client and replayed
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return record
+
+class BroadcastHandler(logging.Handler):
     def __init__(self, state):
         super().__init__()
         self.state = state
 
-    def filter(self, record):
-        if config.should_broadcast_logger(record.name):
-
-            message = f"[{record.levelname}] [{record.name}] {record.getMessage()}"
-            self.state.broadcaster.push(message)
-        return False
+    def emit(self, record):
+        if record is self.state.broadcaster.CLEAR_HISTORY:
+            self.state.broadcaster.drop_history()
+            return
+        message = f"[{record.levelname}] [{record.name}] {record.getMessage()}"
+        self.state.broadcaster.push(message)
 
 logging.Formatter.formatTime = (lambda self, record, datefmt=None: datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).astimezone().isoformat(sep="T",timespec="milliseconds"))
 
@@ -22,9 +37,13 @@ def create_app():
     logging.basicConfig(format=config.log_template, level=logging.getLevelName(config.log_level))
 
     from .state import state
-    broadcast_handler = logging.StreamHandler()
-    broadcast_handler.addFilter(BroadcastFilter(state))
-    logging.getLogger().addHandler(broadcast_handler)
+    # logging only pays for a queue put, the listener thread hands records to the broadcaster
+    broadcast_queue = queue.SimpleQueue()
+    queue_handler = BroadcastQueueHandler(broadcast_queue)
+    queue_handler.addFilter(BroadcastFilter())
+    logging.getLogger().addHandler(queue_handler)
+    logging.handlers.QueueListener(broadcast_queue, BroadcastHandler(state)).start()
+    state.broadcaster.set_log_queue(broadcast_queue)
 
     routes.add_routes(app)
 
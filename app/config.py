@@ -23,6 +23,27 @@ def parse_timespan(s):
         seconds=int(gd['s'] or 0)
     )
 
+_size_pattern = re.compile(r"^\s*(?P<value>[0-9]+)\s*(?P<unit>[kmg]?i?b?)?\s*$", re.IGNORECASE)
+_size_units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+def parse_size(s):
+    size_match = _size_pattern.match(s)
+    if size_match is None:
+        raise ValueError(f'unable to parse size string {s}')
+    unit = (size_match.group('unit') or '').lower().rstrip('b').rstrip('i')
+    return int(size_match.group('value')) * _size_units[unit]
+
+def parse_domain_limits(s):
+    limits = {}
+    for item in s.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        domain, sep, limit = item.partition('=')
+        if not sep:
+            raise ValueError(f'unable to parse registry limit {item}, expected <domain>=<limit>')
+        limits[domain.strip()] = int(limit)
+    return limits
+
 
 class Config:
     def __init__(self):
@@ -32,6 +53,7 @@ class Config:
         self.server_port = int(os.getenv('TL_SERVER_PORT', 5001))
         self.db_path = os.getenv('TL_DB_PATH', '/data/talaria.db')
         self.db_path = os.path.abspath(self.db_path)
+        self.db_read_pool_size = int(os.getenv('TL_DB_READ_POOL_SIZE', 4))
         self.webhook_api_key = os.getenv('TL_WEBHOOK_API_KEY', '57d88647-208e-4ee1-88fc-365836f95ee4')
 
         update_delay = os.getenv('TL_UPDATE_DELAY', '1d')
@@ -42,6 +64,8 @@ class Config:
             'app.scanner',
             'app.docker_compose_file'
         ]
+        self._broadcast_logger_cache: dict[str, bool] = {}
+        self.log_replay_lines = int(os.getenv('TL_LOG_REPLAY_LINES', 1000))
 
         self.git_repo_path = os.getenv('TL_GIT_REPO_PATH', '/data/repository')
         self.git_repo_path = os.path.abspath(self.git_repo_path)
@@ -50,13 +74,29 @@ class Config:
         self.git_auth_token = os.environ['TL_GIT_AUTH_TOKEN']
         self.git_user_email = os.getenv('TL_GIT_USER_EMAIL', 'talaria@example.com')
         self.git_user_name = os.getenv('TL_GIT_USER_NAME', 'talaria')
+        self.git_persistent_workspace = parse_bool_env_var('TL_GIT_PERSISTENT_WORKSPACE', True)
+        self.git_sparse_checkout = parse_bool_env_var('TL_GIT_SPARSE_CHECKOUT', False)
 
 
         self.docker_compose_file_pattern = os.getenv('TL_DOCKER_COMPOSE_FILE_PATTERN', 'docker-compose*.y*ml')
+        self.docker_compose_ignore_dirs = {'.git'} | {d.strip() for d in os.getenv('TL_DOCKER_COMPOSE_IGNORE_DIRS', '').split(',') if d.strip()}
+        self.docker_compose_parse_workers = int(os.getenv('TL_DOCKER_COMPOSE_PARSE_WORKERS', 4))
+        self.docker_compose_parse_cache = parse_bool_env_var('TL_DOCKER_COMPOSE_PARSE_CACHE', True)
 
         self.valid_releases = os.getenv('TL_VALID_RELEASES', 'latest|stable|mainline|develop')
+        self.tag_parse_cache_size = int(os.getenv('TL_TAG_PARSE_CACHE_SIZE', 65536))
         self.enable_talos_compatibility = parse_bool_env_var('TL_TALOS_COMPAT', False)
         self.maximum_concurrent_pushes = int(os.getenv('TL_MAX_CONCURRENT_PUSHES', 5))
+        self.scan_queue_size = int(os.getenv('TL_SCAN_QUEUE_SIZE', 256))
+        self.incremental_scan = parse_bool_env_var('TL_INCREMENTAL_SCAN', False)
+        incremental_scan_max_age = os.getenv('TL_INCREMENTAL_SCAN_MAX_AGE', '7d')
+        self.incremental_scan_max_age = parse_timespan(incremental_scan_max_age)
+        self.pending_updates_limit = int(os.getenv('TL_PENDING_UPDATES_LIMIT', 2 * self.maximum_concurrent_pushes))
+        pending_update_max_age = os.getenv('TL_PENDING_UPDATE_MAX_AGE', '7d')
+        self.pending_update_max_age = parse_timespan(pending_update_max_age)
+        self.maximum_concurrent_lookups = int(os.getenv('TL_MAX_CONCURRENT_LOOKUPS', 8))
+        self.maximum_concurrent_lookups_per_registry = int(os.getenv('TL_MAX_CONCURRENT_LOOKUPS_PER_REGISTRY', 4))
+        self.registry_concurrency_limits = parse_domain_limits(os.getenv('TL_REGISTRY_CONCURRENCY_LIMITS', ''))
 
         # Skopeo cache settings
         skopeo_cache_duration = os.getenv('TL_SKOPEO_CACHE_DURATION', '12h')
@@ -64,6 +104,17 @@ class Config:
         
         skopeo_cache_variance = os.getenv('TL_SKOPEO_CACHE_VARIANCE', '0.1')
         self.skopeo_cache_variance = float(skopeo_cache_variance)
+
+        self.skopeo_cache_memory_entries = int(os.getenv('TL_SKOPEO_CACHE_MEMORY_ENTRIES', 2048))
+        self.skopeo_cache_memory_bytes = parse_size(os.getenv('TL_SKOPEO_CACHE_MEMORY_SIZE', '64MB'))
+        self.skopeo_cache_parsed_tags = parse_bool_env_var('TL_SKOPEO_CACHE_PARSED_TAGS', True)
+        self.skopeo_cache_max_size = parse_size(os.getenv('TL_SKOPEO_CACHE_MAX_SIZE', '256MB'))
+
+        # Database maintenance settings
+        cache_maintenance_interval = os.getenv('TL_CACHE_MAINTENANCE_INTERVAL', '1h')
+        self.cache_maintenance_interval = parse_timespan(cache_maintenance_interval)
+        self.cache_maintenance_batch_size = int(os.getenv('TL_CACHE_MAINTENANCE_BATCH_SIZE', 500))
+        self.db_incremental_vacuum_pages = int(os.getenv('TL_DB_INCREMENTAL_VACUUM_PAGES', 1000))
         
         # Docker.io authentication for skopeo
         self.docker_username = os.getenv('TL_DOCKER_USERNAME')
@@ -71,10 +122,26 @@ class Config:
         self.docker_auth_file = os.getenv('TL_DOCKER_AUTH_FILE', '/data/skopeo-auth.json')
         self.docker_auth_file = os.path.abspath(self.docker_auth_file)
 
+        # Registry lookup backend, either 'skopeo' or 'http' (registry v2 api with skopeo as a fallback)
+        self.registry_backend = os.getenv('TL_REGISTRY_BACKEND', 'skopeo').lower()
+        if self.registry_backend not in ['skopeo', 'http']:
+            raise ValueError(f'invalid registry backend {self.registry_backend}')
+        self.insecure_registries = [r.strip() for r in os.getenv('TL_INSECURE_REGISTRIES', '').split(',') if r.strip()]
+
         self.default_update_history_page_size = os.getenv('TL_HISTORY_PAGE_SIZE', 5)
 
+        # Live scan output streamed to the web interface
+        self.ws_flush_interval = float(os.getenv('TL_WS_FLUSH_INTERVAL', 0.25))
+        self.ws_client_queue_size = int(os.getenv('TL_WS_CLIENT_QUEUE_SIZE', 64))
+        self.ws_max_buffered_lines = int(os.getenv('TL_WS_MAX_BUFFERED_LINES', 1000))
+
     def should_broadcast_logger(self, logger_name: str) -> bool:
-        return any(logger_name.startswith(broadcast_logger) for broadcast_logger in self.broadcast_loggers)
+        # there are only a handful of logger names, so remember the answer for each
+        result = self._broadcast_logger_cache.get(logger_name)
+        if result is None:
+            result = any(logger_name.startswith(broadcast_logger) for broadcast_logger in self.broadcast_loggers)
+            self._broadcast_logger_cache[logger_name] = result
+        return result
 
 
 
@@ -1,28 +1,172 @@
-from pathlib import Path
+from pathlib import PurePosixPath
+from concurrent.futures import Future, ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from typing import AsyncIterator, Iterator
 from .models import DockerComposeTarget, BumpSize
 from .config import config
+from .state import state
+import asyncio
+import hashlib
+import json
 import logging
+import os
 import re
+import shutil
+import tempfile
+import threading
 
 _logger = logging.getLogger(__name__)
 
+_parse_executor: ThreadPoolExecutor | None = None
+
+def _get_parse_executor() -> ThreadPoolExecutor:
+    global _parse_executor
+    if _parse_executor is None:
+        _parse_executor = ThreadPoolExecutor(max_workers=config.docker_compose_parse_workers, thread_name_prefix='compose-parse')
+    return _parse_executor
+
+def _walk_docker_compose_files(stop: threading.Event | None = None) -> Iterator[str]:
+    """Walk the repository with scandir, pruning ignored directories instead of descending into them"""
+    pattern = config.docker_compose_file_pattern
+    ignore_dirs = config.docker_compose_ignore_dirs
+    # like rglob, a pattern without a slash is matched against the file name alone
+    match_name = '/' not in pattern
+
+    directories = [(config.git_repo_path, '')]
+    while directories:
+        if stop is not None and stop.is_set():
+            return
+        directory, relative_directory = directories.pop()
+        subdirectories = []
+        try:
+            # entries are sorted so files are always found in the same order, the files of a directory before its subdirectories
+            with os.scandir(directory) as scanned:
+                entries = sorted(scanned, key=lambda entry: entry.name)
+            for entry in entries:
+                relative_path = f'{relative_directory}{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignore_dirs:
+                        subdirectories.append((entry.path, f'{relative_path}/'))
+                elif entry.is_file() and (fnmatchcase(entry.name, pattern) if match_name else PurePosixPath(relative_path).match(pattern)):
+                    _logger.debug(f"Found docker-compose file: {entry.path}")
+                    yield os.path.abspath(entry.path)
+        except OSError as e:
+            _logger.warning(f"Unable to read directory {directory}: {e}")
+        directories.extend(reversed(subdirectories))
+
 def get_docker_compose_files():
-    repo_path = Path(config.git_repo_path)
-    
-    docker_compose_files = []
-    for file_path in repo_path.rglob(config.docker_compose_file_pattern):
-        if '.git' in file_path.parts:
-            continue
-        
-        docker_compose_files.append(str(file_path.absolute()))
-        _logger.debug(f"Found docker-compose file: {file_path}")
-    
+    docker_compose_files = sorted(_walk_docker_compose_files())
     _logger.info(f"Found {len(docker_compose_files)} docker-compose files")
     return docker_compose_files
 
+# bump whenever get_images changes what it finds in an unchanged file, so cached parses are not reused
+_PARSER_VERSION = 2
+
+def _get_content_key(file_path: str, file_hashes: dict[str, str]) -> str:
+    """Identify the content of a file and the parser settings it was parsed with"""
+    content_hash = file_hashes.get(file_path)
+    if content_hash is None:
+        # not tracked or modified in the working tree, so hash the content instead
+        with open(file_path, 'rb') as f:
+            content_hash = f'sha256:{hashlib.sha256(f.read()).hexdigest()}'
+    return f'{_PARSER_VERSION}:{config.enable_talos_compatibility}:{content_hash}'
+
+def _dumps_images(targets: list[DockerComposeTarget], errors: list[str]) -> str:
+    return json.dumps({
+        'targets': [[t.service_key, t.line, t.current_image_string, int(t.bump), t.skip] for t in targets],
+        'errors': errors
+    })
+
+def _loads_images(file_path: str, data: str) -> tuple[list[DockerComposeTarget], list[str]]:
+    parsed = json.loads(data)
+    targets = [DockerComposeTarget(
+        file_path=file_path,
+        service_key=service_key,
+        line=line,
+        current_image_string=current_image_string,
+        bump=BumpSize(bump),
+        skip=skip
+    ) for service_key, line, current_image_string, bump, skip in parsed['targets']]
+    return targets, parsed['errors']
+
+def _get_images_cached(file_path: str, file_hashes: dict[str, str] | None) -> tuple[list[DockerComposeTarget], list[str]]:
+    if file_hashes is None or not config.docker_compose_parse_cache:
+        return get_images(file_path)
+
+    content_key = _get_content_key(file_path, file_hashes)
+    cached_result = state.compose_parse_cache.get(file_path, content_key)
+    if cached_result is not None:
+        _logger.debug(f"Using cached parse of unchanged docker-compose file: {file_path}")
+        return _loads_images(file_path, cached_result)
+
+    targets, errors = get_images(file_path)
+    state.compose_parse_cache.set(file_path, content_key, _dumps_images(targets, errors))
+    return targets, errors
+
+def _try_get_images(file_path: str, file_hashes: dict[str, str] | None) -> tuple[list[DockerComposeTarget], list[str]]:
+    try:
+        return _get_images_cached(file_path, file_hashes)
+    except Exception as e:
+        return [], [f"Failed to parse docker compose file: {e}"]
+
+async def discover_targets(file_hashes: dict[str, str] | None = None) -> AsyncIterator[tuple[str, list[DockerComposeTarget], list[str]]]:
+    """Find and parse docker-compose files on worker threads, yielding the targets and errors of each file in the order the files are found.
+    When given the git blob sha of each file, unchanged files are read from the parse cache instead of being parsed again"""
+    loop = asyncio.get_running_loop()
+    executor = _get_parse_executor()
+    # holds (file path, parse future) for each file in the order it was found, and (None, None) once the walk is over
+    submitted: asyncio.Queue[tuple[str | None, Future | None]] = asyncio.Queue()
+    stop = threading.Event()
+    futures: list[Future] = []
+    # the walk only runs a few files ahead of the consumer, so a slow consumer holds back parsing too
+    parse_slots = threading.Semaphore(config.docker_compose_parse_workers * 2)
+
+    def walk() -> int:
+        count = 0
+        try:
+            for file_path in _walk_docker_compose_files(stop):
+                while not parse_slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return count
+                # the consumer may have finished while the walk waited for a slot
+                if stop.is_set():
+                    return count
+                future = executor.submit(_try_get_images, file_path, file_hashes)
+                futures.append(future)
+                loop.call_soon_threadsafe(submitted.put_nowait, (file_path, future))
+                count += 1
+        finally:
+            if not stop.is_set():
+                loop.call_soon_threadsafe(submitted.put_nowait, (None, None))
+        return count
+
+    walk_task = asyncio.ensure_future(asyncio.to_thread(walk))
+    found: set[str] = set()
+    try:
+        while True:
+            file_path, future = await submitted.get()
+            if file_path is None:
+                break
+            targets, errors = await asyncio.wrap_future(future)
+            found.add(file_path)
+            parse_slots.release()
+            yield file_path, targets, errors
+        # raises any error hit by the walk
+        total = await walk_task
+    finally:
+        # stop walking if the consumer finishes early, and once the walk has stopped submitting, drop the files still waiting to be parsed
+        stop.set()
+        await asyncio.wait([walk_task])
+        for future in futures:
+            future.cancel()
+
+    _logger.info(f"Found {total} docker-compose files")
+    if file_hashes is not None and config.docker_compose_parse_cache:
+        await asyncio.to_thread(state.compose_parse_cache.retain, found)
+
 def _remove_quotes(item: str):
-    if (item.startswith("'") and item.endswith("'")) or \
-        (item.startswith('"') and item.endswith('"')):
+    quote = item[:1]
+    if (quote == '"' or quote == "'") and item.endswith(quote):
         return item[1:-1]
     return item
 
@@ -30,103 +174,37 @@ def _get_indentation(line: str) -> int:
     """Get the indentation level of a line"""
     return len(line) - len(line.lstrip())
 
-def _find_service_key(lines: list[str], current_line_num: int) -> str:
-    """Find the service key by looking up for the first line with less indentation"""
-    current_indent = _get_indentation(lines[current_line_num])
-    
-    # Search upwards for the service key
-    for i in range(current_line_num - 1, -1, -1):
-        line = lines[i]
-        indent = _get_indentation(line)
-        if indent < current_indent and ':' in line and not line.strip().startswith('#'):
-            # Found the service key
-            return line.split(':')[0].strip()
-    
-    raise ValueError(f"Unable to find service key") 
-
+_bump_values = {
+    'major': BumpSize.MAJOR,
+    'minor': BumpSize.MINOR,
+    'patch': BumpSize.PATCH,
+    'digest': BumpSize.DIGEST,
+}
+_skip_values = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
 
 def _parse_bump_value(value: str) -> BumpSize:
     """Parse bump value from string"""
     value = _remove_quotes(value)
-    value_lower = value.lower().strip()
-    if value_lower == "major":
-        return BumpSize.MAJOR
-    elif value_lower == "minor":
-        return BumpSize.MINOR
-    elif value_lower == "patch":
-        return BumpSize.PATCH
-    elif value_lower == "digest":
-        return BumpSize.DIGEST
-    else:
+    bump = _bump_values.get(value.lower().strip())
+    if bump is None:
         raise ValueError(f"Invalid bump value: {value}")
+    return bump
 
 def _parse_skip_value(value: str) -> bool:
     """Parse skip value from string"""
     value = _remove_quotes(value)
-    value_lower = value.lower().strip()
-    if value_lower in ["true", "yes", "1"]:
-        return True
-    elif value_lower in ["false", "no", "0"]:
+    skip = _skip_values.get(value.lower().strip())
+    if skip is not None:
+        return skip
+    # Try to parse as number
+    try:
+        num = int(value)
+        return num > 0
+    except ValueError:
         return False
-    else:
-        # Try to parse as number
-        try:
-            num = int(value)
-            return num > 0
-        except ValueError:
-            return False
-
-def _find_x_config(lines: list[str], current_line_num: int, current_indent: int) -> tuple[BumpSize, bool]:
-    # Search downwards for x-talos or x-tl at the same indentation level
-    for i in range(current_line_num + 1, len(lines)):
-        line = lines[i]
-        indent = _get_indentation(line)
-        
-        # If we've gone to a higher level, stop searching
-        if indent < current_indent:
-            break
-            
-        if indent == current_indent:
-            line_stripped = line.strip()
-            
-            if line_stripped.startswith('x-talaria:'):
-                # Parse x-talos configuration
-                return _parse_x_talaria_config(lines, i, current_indent)
-            elif line_stripped.startswith('x-tl:'):
-                # Parse x-tl configuration
-                return _parse_x_tl_config(line_stripped)
-            elif config.enable_talos_compatibility and line_stripped.startswith('x-talos:'):
-                # Parse x-talos configuration
-                return _parse_x_talaria_config(lines, i, current_indent)
-    
-    raise ValueError(f"Unable to find talaria configuration")
-
-def _parse_x_talaria_config(lines: list[str], start_line: int, base_indent: int) -> tuple[BumpSize, bool]:
-    """Parse x-talos configuration block"""
-    bump = BumpSize.DIGEST
-    skip = False
-    
-    for i in range(start_line + 1, len(lines)):
-        line = lines[i]
-        indent = _get_indentation(line)
-        
-        if indent <= base_indent:
-            break
-            
-        if indent > base_indent:
-            line_stripped = line.strip()
-            if line_stripped.startswith('bump:'):
-                value = line.split(':', 1)[1].strip()
-                bump = _parse_bump_value(value)
-            elif line_stripped.startswith('skip:'):
-                value = line.split(':', 1)[1].strip()
-                skip = _parse_skip_value(value)
-    
-    return bump, skip
-
-def _parse_x_tl_config(line: str) -> tuple[BumpSize, bool]:
+
+def _parse_x_tl_value(value: str) -> tuple[BumpSize, bool]:
     """Parse x-tl configuration (single line format)"""
-    value = line.split(':', 1)[1].strip()
     value = _remove_quotes(value)
     if config.enable_talos_compatibility:
         if len(value) > 0:
@@ -144,69 +222,256 @@ def _parse_x_tl_config(line: str) -> tuple[BumpSize, bool]:
     else:
         raise ValueError(f"Invalid x-tl value: {value}")
 
+def _parse_x_talaria_values(values: dict[str, str]) -> tuple[BumpSize, bool]:
+    """Parse the bump and skip values of an x-talaria block"""
+    bump = values.get('bump')
+    skip = values.get('skip')
+    return BumpSize.DIGEST if bump is None else _parse_bump_value(bump), skip is not None and _parse_skip_value(skip)
+
+def _parse_flow_mapping(value: str) -> dict[str, str]:
+    """Parse a single line flow mapping such as {bump: minor, skip: false}"""
+    values = {}
+    for item in value[1:-1].split(','):
+        key, sep, item_value = item.partition(':')
+        if sep:
+            values[_remove_quotes(key.strip())] = item_value.strip()
+    return values
+
+def _strip_comment(text: str) -> str:
+    """Remove a trailing comment, ignoring any # inside quotes"""
+    if '#' not in text:
+        return text
+    quote = None
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '#' and (i == 0 or text[i - 1] in ' \t'):
+            return text[:i].rstrip()
+    return text
+
+_key_value_regex = re.compile(r"(\"[^\"]*\"|'[^']*'|[^\s:'\"#][^:]*?)\s*:(?:\s+(.*))?$")
+_node_properties_regex = re.compile(r"^(?:(?:&|!)\S*\s*)+")
+# the first characters of lines that can never start a mapping key; list items never hold services or talaria configuration,
+# and tab indented lines are reported as errors
+_skipped_line_starts = frozenset(['', '\n', '\r', '#', '-', '\t'])
+
+# keys are only parsed on lines that may hold an image or talaria configuration, the rest just track indentation
+_interesting_key_starts = ('image', 'x-', '"', "'")
+_node_property_starts = frozenset(['&', '!'])
+
+def _split_key_value(content: str) -> tuple[str, str] | None:
+    """Split a line into its unquoted mapping key and stripped value, or None if it is not a mapping entry.
+    Finds the same keys as _key_value_regex, which is only run for quoted keys as it costs several times more than a partition"""
+    key, sep, value = content.partition(':')
+    if not sep:
+        return None
+    first_char = key[:1]
+    if first_char == '"' or first_char == "'":
+        match = _key_value_regex.match(content)
+        return (match.group(1)[1:-1], (match.group(2) or '').strip()) if match else None
+    if not first_char or first_char == '#' or first_char.isspace() or (value and not value[0].isspace()):
+        return None
+    return key.rstrip(), value.strip()
+
+def _parse_key(content: str | None) -> str | None:
+    """Get the mapping key of a line, if it has one"""
+    key_value = _split_key_value(content) if content else None
+    return key_value[0] if key_value else None
+
+def _parse_value(value: str) -> str:
+    """Strip the comment, anchor and tag from a scalar value split from its key"""
+    if '#' in value:
+        value = _strip_comment(value)
+    first_char = value[:1]
+    if first_char in _node_property_starts:
+        value = _node_properties_regex.sub('', value)
+        first_char = value[:1]
+    if (first_char == '"' or first_char == "'") and value.endswith(first_char):
+        return value[1:-1]
+    return value
+
+class _Node:
+    """A mapping key holding images or talaria configuration"""
+    __slots__ = ('key', 'images', 'x_config', 'x_config_error')
+
+    def __init__(self, key: str | None):
+        self.key = key
+        self.images: list[tuple[int, str]] = []
+        self.x_config: tuple[BumpSize, bool] | None = None
+        self.x_config_error: str | None = None
+
+    def set_x_config(self, parse, value):
+        # the first talaria configuration of a service wins
+        if self.x_config is not None or self.x_config_error is not None:
+            return
+        try:
+            self.x_config = parse(value)
+        except Exception as e:
+            self.x_config_error = str(e)
+
 def get_images(file_path: str) -> tuple[list[DockerComposeTarget], list[str]]:
-    targets: list[DockerComposeTarget] = []
-    errors: list[str] = []
-    
+    """Find every image in the file along with its talaria configuration, in a single pass over the lines.
+    Lines indented with tabs, or dedented to an indentation no enclosing line has, are reported as errors"""
     with open(file_path, 'r') as f:
         lines = f.readlines()
-        
+
+    x_talaria_keys = ('x-talaria', 'x-talos') if config.enable_talos_compatibility else ('x-talaria',)
+    # the nodes holding images, in the order they were found
+    nodes: list[_Node] = []
+    errors: list[tuple[int, str]] = []
+    # the lines enclosing the current line as (indent, content, node), each more indented than the last
+    # nodes, and their keys, are only made for lines that turn out to hold an image or talaria configuration
+    stack: list[tuple[int, str | None, _Node | None]] = [(-1, None, None)]
+    top_indent = -1
+    # the x-talaria block being read, whose values are set on its node once a line is no longer nested in it
+    x_talaria_values: dict[str, str] | None = None
+    x_talaria_node: _Node | None = None
+    x_talaria_indent = x_talaria_value_indent = -1
+
+    def get_parent() -> _Node:
+        indent, content, node = stack[-1]
+        if node is None:
+            node = _Node(_parse_key(content))
+            nodes.append(node)
+            stack[-1] = (indent, content, node)
+        return node
+
     for line_num, line in enumerate(lines):
-        line = line.strip()
-        if line.startswith('image:'):
-            # Extract the image name after 'image:'
-            image = line[6:].strip()
-            # Remove quotes if present
-            if image.startswith('"') and image.endswith('"'):
-                image = image[1:-1]
-            elif image.startswith("'") and image.endswith("'"):
-                image = image[1:-1]
-            
-            if not image:  # Only add if image is not empty
+        content = line.lstrip(' ')
+        first_char = content[:1]
+        if first_char in _skipped_line_starts:
+            if first_char == '\t' and content.strip() and not content.lstrip().startswith('#'):
+                errors.append((line_num, f"Unable to parse line {line_num + 1}: tabs are not allowed in indentation"))
+            continue
+        indent = len(line) - len(content)
+
+        if x_talaria_values is not None:
+            if indent > x_talaria_indent:
+                if x_talaria_value_indent < 0:
+                    x_talaria_value_indent = indent
+                if indent == x_talaria_value_indent:
+                    key_value = _split_key_value(content)
+                    if key_value is not None:
+                        x_talaria_values[key_value[0]] = _parse_value(key_value[1])
+                elif indent < x_talaria_value_indent:
+                    errors.append((line_num, f"Unable to parse line {line_num + 1}: indentation does not match any enclosing line"))
                 continue
+            x_talaria_node.set_x_config(_parse_x_talaria_values, x_talaria_values)
+            x_talaria_values = None
 
-            try:
-                # Find the service key
-                service_key = _find_service_key(lines, line_num)
-                
-                # Find x-talos or x-tl configuration
-                current_indent = _get_indentation(lines[line_num])
-                bump, skip = _find_x_config(lines, line_num, current_indent)
-                
-                target = DockerComposeTarget(
-                    file_path=file_path,
-                    service_key=service_key,
-                    line=line_num,
-                    current_image_string=image,
-                    bump=bump,
-                    skip=skip
-                )
-                
-                targets.append(target)
-                _logger.debug(f"Found image '{image}' at line {line_num + 1} in service '{service_key}'")
-                
-            except Exception as e:
-                error_msg = f"Failed to parse image at line {line_num + 1}: {e}"
-                errors.append(error_msg)
-
-    
-    return targets, errors
+        if indent == top_indent:
+            # a sibling of the line before takes its place
+            stack.pop()
+        elif indent < top_indent:
+            while indent < top_indent:
+                stack.pop()
+                top_indent = stack[-1][0]
+            if indent != top_indent:
+                # the key of the line is not used, so images right under it are reported as missing their service key
+                errors.append((line_num, f"Unable to parse line {line_num + 1}: indentation does not match any enclosing line"))
+                stack.append((indent, None, None))
+                top_indent = indent
+                continue
+            stack.pop()
+
+        if content.startswith(_interesting_key_starts):
+            key_value = _split_key_value(content)
+            if key_value is not None:
+                key, value = key_value
+                if key == 'image':
+                    value = _parse_value(value)
+                    if value and not value.startswith('*'):
+                        get_parent().images.append((line_num, value))
+                elif key == 'x-tl':
+                    get_parent().set_x_config(_parse_x_tl_value, _parse_value(value))
+                elif key in x_talaria_keys:
+                    value = _parse_value(value)
+                    if value.startswith('{'):
+                        get_parent().set_x_config(_parse_x_talaria_values, _parse_flow_mapping(value))
+                    elif not value:
+                        x_talaria_values = {}
+                        x_talaria_node = get_parent()
+                        x_talaria_indent = indent
+                        x_talaria_value_indent = -1
+        stack.append((indent, content, None))
+        top_indent = indent
+
+    if x_talaria_values is not None:
+        x_talaria_node.set_x_config(_parse_x_talaria_values, x_talaria_values)
+
+    targets: list[DockerComposeTarget] = []
+    debug = _logger.isEnabledFor(logging.DEBUG)
+    for node in nodes:
+        for line_num, image in node.images:
+            if node.key is None:
+                errors.append((line_num, f"Failed to parse image at line {line_num + 1}: Unable to find service key"))
+            elif node.x_config_error is not None:
+                errors.append((line_num, f"Failed to parse image at line {line_num + 1}: {node.x_config_error}"))
+            elif node.x_config is None:
+                errors.append((line_num, f"Failed to parse image at line {line_num + 1}: Unable to find talaria configuration"))
+            else:
+                bump, skip = node.x_config
+                targets.append(DockerComposeTarget(file_path, node.key, line_num, image, bump, skip))
+                if debug:
+                    _logger.debug(f"Found image '{image}' at line {line_num + 1} in service '{node.key}'")
+
+    targets.sort(key=lambda t: t.line)
+    errors.sort()
+    return targets, [error for _, error in errors]
+
+def _holds_image(line: str, image: str) -> bool:
+    """Check that a line is still the image line the target was parsed from"""
+    key_value = _split_key_value(line.lstrip(' '))
+    return key_value is not None and key_value[0] == 'image' and _parse_value(key_value[1]) == image
+
+def _write_atomic(file_path: str, lines: list[str]):
+    """Write to a temporary file next to the original and rename it over the original, so the file is never left half written"""
+    directory, name = os.path.split(file_path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+def apply_updates(updates: list[tuple[DockerComposeTarget, str]]) -> list[DockerComposeTarget]:
+    """Apply updates by replacing their image lines, reading and writing each file once.
+    Targets whose line no longer holds their image are skipped. Returns the targets that were applied"""
+    updates_by_file: dict[str, list[tuple[DockerComposeTarget, str]]] = {}
+    for target, new_image in updates:
+        updates_by_file.setdefault(target.file_path, []).append((target, new_image))
+
+    applied: list[DockerComposeTarget] = []
+    for file_path, file_updates in updates_by_file.items():
+        with open(file_path, 'r') as f:
+            lines = f.readlines()
+
+        file_applied = []
+        for target, new_image in file_updates:
+            if target.line >= len(lines):
+                _logger.warning(f"Line {target.line} is out of bounds for file {file_path}, skipping update of {target.service_key}")
+                continue
+            original_line = lines[target.line]
+            if not _holds_image(original_line, target.current_image_string):
+                _logger.warning(f"Line {target.line + 1} of {file_path} no longer holds image '{target.current_image_string}', skipping update of {target.service_key}")
+                continue
+
+            indent_str = ' ' * _get_indentation(original_line)
+            lines[target.line] = f"{indent_str}image: {new_image}\n"
+            file_applied.append(target)
+
+        if file_applied:
+            _write_atomic(file_path, lines)
+            applied.extend(file_applied)
+    return applied
 
 def apply_update(target: DockerComposeTarget, new_image: str):
     """Apply the update to the docker-compose file by replacing the image line"""
-    with open(target.file_path, 'r') as f:
-        lines = f.readlines()
-    
-    line_index = target.line
-    if line_index >= len(lines):
-        raise ValueError(f"Line {target.line} is out of bounds for file {target.file_path}")
-    
-    original_line = lines[line_index]
-    indent = _get_indentation(original_line)
-    indent_str = ' ' * indent
-    
-    new_line = f"{indent_str}image: {new_image}\n"
-    lines[line_index] = new_line
-    
-    with open(target.file_path, 'w') as f:
-        f.writelines(lines)
+    if not apply_updates([(target, new_image)]):
+        raise ValueError(f"Line {target.line + 1} of file {target.file_path} no longer holds image '{target.current_image_string}'")
@@ -20,19 +20,11 @@ def handle_deployment_webhook(data, event):
     sha = data.get("object_attributes", {}).get("sha")
     if sha is None:
         return
-    commit = state.commit.get(sha)
-    if commit is None:
-        return 
-
-    if status == "success":
-        commit.pipeline_status = PipelineStatus.SUCCESS
-    else:
-        commit.pipeline_status = PipelineStatus.FAILURE
-
-    commit.commit_url = data.get("commit", {}).get("url")
-    commit.pipeline_url = data.get("object_attributes", {}).get("url")
-    commit.pipeline_timestamp = time.time()
-    commit.pipeline_duration = data.get("object_attributes", {}).get("duration")
-
-    state.commit[sha] = commit
-
+    state.commit.set_pipeline(
+        sha,
+        pipeline_status=PipelineStatus.SUCCESS if status == "success" else PipelineStatus.FAILURE,
+        commit_url=data.get("commit", {}).get("url"),
+        pipeline_url=data.get("object_attributes", {}).get("url"),
+        pipeline_timestamp=time.time(),
+        pipeline_duration=data.get("object_attributes", {}).get("duration")
+    )
@@ -1,4 +1,6 @@
 import re
+from functools import lru_cache
+from typing import Iterable
 from .config import config
 from .models import ParsedImage, ParsedTag, ParsedTagAndDigest, SemanticVersion
 
@@ -24,6 +26,13 @@ _image_regex = re.compile(f"^{_image_pattern}$")
 _tag_and_digest_regex = re.compile(f"^{_tag_and_digest_pattern}$")
 _tag_regex = re.compile(f"^{_tag_pattern}$")
 
+# positions of the tag groups in each regex, so a tag can be read out with a single match.group call
+_tag_group_names = ("versionprefix", "major", "minor", "patch", "release", "variant")
+_tag_group_indexes = {
+    regex: tuple(regex.groupindex[name] for name in _tag_group_names)
+    for regex in (_image_regex, _tag_and_digest_regex, _tag_regex)
+}
+
 
 def parse(image: str, insert_default_domain: bool = True) -> ParsedImage:
     parsed = try_parse(image, insert_default_domain)
@@ -76,35 +85,42 @@ def _try_parse_tag_and_digest(match: re.Match) -> ParsedTagAndDigest | None:
     return ParsedTagAndDigest(tag=tag, digest=digest)
 
 
+@lru_cache(maxsize=config.tag_parse_cache_size)
 def try_parse_tag(text: str) -> ParsedTag | None:
+    # memoized, so every occurrence of a tag string across images and scans shares one ParsedTag
     match = _tag_regex.match(text)
     if not match:
         return None
     return _try_parse_tag(match)
 
 
+def parse_tags(tags: Iterable[str]) -> list[ParsedTag]:
+    """Parse many tags at once, dropping any that are not versions or releases"""
+    return [tag for tag in map(try_parse_tag, tags) if tag is not None]
+
+
 def _try_parse_tag(match: re.Match) -> ParsedTag | None:
-    major = _get_group(match, "major")
+    prefix, major, minor, patch, release, variant = match.group(*_tag_group_indexes[match.re])
     if major:
-        version = SemanticVersion(
-            version_prefix=_get_group(match, "versionprefix"),
-            major=int(major),
-            minor=_parse_int_group(match, "minor"),
-            patch=_parse_int_group(match, "patch"),
+        version = _get_semantic_version(
+            prefix or None,
+            int(major),
+            int(minor) if minor else None,
+            int(patch) if patch else None,
         )
-    elif release := _get_group(match, "release"):
+    elif release:
         version = release
     else:
         return None
 
-    variant = _get_group(match, "variant")
-    return ParsedTag(version=version, variant=variant)
+    return ParsedTag(version=version, variant=variant or None)
 
 
-def _get_group(match: re.Match, key: str) -> str | None:
-    return match.groupdict().get(key) or None
+@lru_cache(maxsize=config.tag_parse_cache_size)
+def _get_semantic_version(version_prefix: str | None, major: int, minor: int | None, patch: int | None) -> SemanticVersion:
+    return SemanticVersion(version_prefix=version_prefix, major=major, minor=minor, patch=patch)
+
 
+def _get_group(match: re.Match, key: str) -> str | None:
+    return match.group(key) or None
 
-def _parse_int_group(match: re.Match, key: str) -> int | None:
-    val = _get_group(match, key)
-    return int(val) if val is not None else None
@@ -1,27 +1,137 @@
-from .models import ParsedImage, ParsedTag, BumpSize, ParsedTagAndDigest
-from . import skopeo, image_parser
-from .models import SemanticVersion, SemanticVersionSize
-from datetime import datetime
-from dateutil.parser import isoparse
+from .models import ParsedImage, ParsedTag, BumpSize, ParsedTagAndDigest, TagSet
+from . import skopeo, registry, image_parser
+from .single_flight import SingleFlight
+from .models import SemanticVersion, SemanticVersionPrecision, SemanticVersionSize
+from .config import config
+from .state import state
+from bisect import bisect_left, bisect_right
+import hashlib
+import httpx
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# concurrent targets sharing an image share a single registry lookup
+_tag_set_flights = SingleFlight()
+_digest_flights = SingleFlight()
+
+async def _list_tags(image: ParsedImage, use_cache: bool = True) -> list[str]:
+    if config.registry_backend == 'http':
+        try:
+            return await registry.list_tags(image, use_cache=use_cache)
+        except (httpx.TransportError, registry.RegistryError) as e:
+            # only fall back when the registry could not be reached or spoken to, errors such as 401 or 404 would fail the same way
+            _logger.warning(f'Registry api tag lookup failed for {image.untagged}, falling back to skopeo: {e}')
+    return await skopeo.list_tags(image.untagged, domain=image.domain, use_cache=use_cache)
+
+async def _get_tag_set(image: ParsedImage) -> TagSet:
+    if not config.skopeo_cache_parsed_tags:
+        return _build_tag_set(await _list_tags(image))
+
+    # cache the parsed form so a cache hit skips both decoding the tag list and parsing every tag
+    cached_result = state.skopeo_cache.get('tag-set', [image.untagged])
+    if cached_result is not None:
+        try:
+            return TagSet.loads(cached_result)
+        except Exception as e:
+            # an unreadable entry, such as one written in an older format, is treated as a miss and overwritten
+            _logger.warning(f'Ignoring unreadable cached tag set for {image.untagged}: {e}')
+    tag_set = _build_tag_set(await _list_tags(image, use_cache=False))
+    state.skopeo_cache.set('tag-set', [image.untagged], tag_set.dumps())
+    return tag_set
+
+def _build_tag_set(tags: list[str]) -> TagSet:
+    tag_set = TagSet()
+    for parsed_tag in image_parser.parse_tags(tags):
+        tag_set.add(parsed_tag)
+    return tag_set
+
+async def _get_digest(image: ParsedImage, tag: ParsedTag) -> str:
+    if config.registry_backend == 'http':
+        try:
+            return await registry.get_digest(image, str(tag))
+        except (httpx.TransportError, registry.RegistryError) as e:
+            # only fall back when the registry could not be reached or spoken to, errors such as 401 or 404 would fail the same way
+            _logger.warning(f'Registry api digest lookup failed for {image.untagged}:{tag}, falling back to skopeo: {e}')
+    return await skopeo.get_digest(f'{image.untagged}:{tag}', domain=image.domain)
+
+class TagIndex:
+    """Tags of an image indexed by version prefix, variant and precision, with each group sorted by version"""
+    def __init__(self, tag_set: TagSet):
+        self.releases = tag_set.releases
+        versions: dict[tuple[str | None, str | None, int], set[int]] = {}
+        for (prefix, variant), numbers in tag_set.versions.items():
+            for n in numbers:
+                versions.setdefault((prefix, variant, len(n)), set()).add(SemanticVersion.pack(*n))
+        # versions are held as packed integer keys, which are compact and compare without attribute lookups
+        self._versions = {k: sorted(v) for k, v in versions.items()}
+        self._fingerprints: dict[tuple[str | None, str | None, int], str] = {}
+
+    def _find(self, active_version: SemanticVersion, variant: str | None, max_bump_size: BumpSize) -> tuple[list[int], int, int]:
+        # only versions with the same precision are considered
+        # (e.g. we wont do v1.2 -> v2 or v1.2 -> v2.0.0, but we will do v1.2 -> v2.0)
+        versions = self._versions.get((active_version.version_prefix, variant, len(active_version.numbers)))
+        if not versions:
+            return [], 0, 0
+
+        active = active_version.sort_key
+        lower = bisect_left(versions, active)
+        if max_bump_size >= BumpSize.MAJOR:
+            upper = len(versions)
+        elif max_bump_size == BumpSize.MINOR or active_version.minor is None:
+            upper = bisect_left(versions, SemanticVersion.pack(active_version.major + 1), lower)
+        elif max_bump_size == BumpSize.PATCH:
+            upper = bisect_left(versions, SemanticVersion.pack(active_version.major, active_version.minor + 1), lower)
+        else:
+            upper = bisect_right(versions, active, lower)
+        return versions, lower, upper
+
+    def get_fingerprint(self, active_version: SemanticVersion, variant: str | None) -> str:
+        """Digest of the versions that candidates for the active version are chosen from.
+        Only tags with the same prefix, variant and precision change it, not every tag pushed to the image"""
+        key = (active_version.version_prefix, variant, len(active_version.numbers))
+        fingerprint = self._fingerprints.get(key)
+        if fingerprint is None:
+            fingerprint = hashlib.sha256(','.join(map(str, self._versions.get(key, ()))).encode()).hexdigest()
+            self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def get_candidates(self, active_version: SemanticVersion, variant: str | None, max_bump_size: BumpSize) -> list[SemanticVersion]:
+        """Get the versions that are at most max_bump_size ahead of the active version, in ascending order"""
+        versions, lower, upper = self._find(active_version, variant, max_bump_size)
+        return [SemanticVersion.unpack(key, active_version.version_prefix) for key in versions[lower:upper]]
+
+    def get_best_candidate(self, active_version: SemanticVersion, variant: str | None, max_bump_size: BumpSize) -> SemanticVersion | None:
+        """Get the highest version that is at most max_bump_size ahead of the active version"""
+        versions, lower, upper = self._find(active_version, variant, max_bump_size)
+        return SemanticVersion.unpack(versions[upper - 1], active_version.version_prefix) if upper > lower else None
+
+# tag indexes are built once per image per scan and shared by every target using that image
+_tag_indexes: dict[str, TagIndex] = {}
+
+def reset_tag_indexes():
+    _tag_indexes.clear()
+
+async def _build_tag_index(image: ParsedImage) -> TagIndex:
+    return TagIndex(await _get_tag_set(image))
+
+async def _get_tag_index(image: ParsedImage) -> TagIndex:
+    tag_index = _tag_indexes.get(image.untagged)
+    if tag_index is None:
+        tag_index = await _tag_set_flights.run(image.untagged, lambda: _build_tag_index(image))
+        _tag_indexes[image.untagged] = tag_index
+    return tag_index
 
 async def get_sorted_candidate_tags(parsed_active_image: ParsedImage, max_bump_size: BumpSize) -> list[ParsedTag]:
-    tags =  await skopeo.list_tags(parsed_active_image.untagged)
-    parsed_tags: list[ParsedTag] = []
-    for tag in tags:
-        parsed_tag = image_parser.try_parse_tag(tag)
-        if parsed_tag is not None:
-            parsed_tags.append(parsed_tag)
+    tag_index = await _get_tag_index(parsed_active_image)
 
     if parsed_active_image.tag_and_digest is None:
         # for missing tags we will add the latest tag and a digest
         # None -> latest@sha256:123
 
-        valid_tags: list[ParsedTag] = []
-        for tag in parsed_tags:
-            if tag.version == "latest" and tag.variant is None:
-                valid_tags.append(tag)
-
-        return [] if len(valid_tags) == 0 else [valid_tags[0]]
+        if ("latest", None) in tag_index.releases:
+            return [ParsedTag(version="latest")]
+        return []
 
     elif isinstance(parsed_active_image.tag_and_digest.tag.version, str):
         # with releases, we will only add the digest if it dne, or update it if there is a newer one
@@ -33,67 +143,35 @@ async def get_sorted_candidate_tags(parsed_active_image: ParsedImage, max_bump_s
         release = parsed_active_image.tag_and_digest.tag.version
         variant = parsed_active_image.tag_and_digest.tag.variant
 
-        valid_tags: list[ParsedTag] = []
-        for tag in parsed_tags:
-            if (isinstance(tag.version, str) and
-                tag.version == release and
-                tag.variant == variant):
-                valid_tags.append(tag)
-
-        return [] if len(valid_tags) == 0 else [valid_tags[0]]
+        if (release, variant) in tag_index.releases:
+            return [ParsedTag(version=release, variant=variant)]
+        return []
 
     else:
         # with semver, we will find all the versions that keep the same precision
-        # (e.g. we wont do v1.2 -> v2 or v1.2 -> v2.0.0, but we will do v1.2 -> v2.0)
         # then filter them by the configured bump level
         # we must also match the variant
         # v1.2.3-alpine@sha256:abc -> v1.3.1-alpine@sha256:abc
 
         active_version = parsed_active_image.tag_and_digest.tag.version
         variant = parsed_active_image.tag_and_digest.tag.variant
+        candidates = tag_index.get_candidates(active_version, variant, max_bump_size)
+
+        return [ParsedTag(version=version, variant=variant) for version in reversed(candidates)]
 
-        valid_versions: list[tuple[SemanticVersion, BumpSize]] = []
-        
-        for parsed_tag in parsed_tags:
-            if not isinstance(parsed_tag.version, SemanticVersion):
-                continue
-            if parsed_tag.version.version_prefix != active_version.version_prefix:
-                continue
-            if parsed_tag.variant != variant:
-                continue
-
-            size = SemanticVersion.compare(active_version, parsed_tag.version)
-            bump_size: BumpSize
-
-            if size == SemanticVersionSize.MAJOR:
-                if max_bump_size < BumpSize.MAJOR:
-                    continue
-                bump_size = BumpSize.MAJOR
-            elif size == SemanticVersionSize.MINOR:
-                if max_bump_size < BumpSize.MINOR:
-                    continue
-                bump_size = BumpSize.MINOR
-            elif size == SemanticVersionSize.PATCH:
-                if max_bump_size < BumpSize.PATCH:
-                    continue
-                bump_size = BumpSize.PATCH
-            elif size == SemanticVersionSize.EQUAL:
-                bump_size = BumpSize.DIGEST
-            else:
-                # SemanticVersionSize.PRECISION_MISMATCH or SemanticVersionSize.DOWNGRADE
-                continue
-
-            valid_versions.append((parsed_tag.version, bump_size))
-
-        if len(valid_versions) == 0:
-            return []
-
-        # Sort by major, minor, patch in descending order
-        sorted_tags = sorted(valid_versions, 
-                           key=lambda x: (x[0].major, x[0].minor or -1, x[0].patch or -1), 
-                           reverse=True)
-
-        return [ParsedTag(version=sv, variant=variant) for sv, _ in sorted_tags]
+async def get_candidate_tag(parsed_active_image: ParsedImage, max_bump_size: BumpSize) -> ParsedTag | None:
+    """Get the best tag to move to, without building the full candidate list"""
+    tag_and_digest = parsed_active_image.tag_and_digest
+    if tag_and_digest is None or isinstance(tag_and_digest.tag.version, str):
+        candidates = await get_sorted_candidate_tags(parsed_active_image, max_bump_size)
+        return candidates[0] if candidates else None
+
+    tag_index = await _get_tag_index(parsed_active_image)
+    active_version = tag_and_digest.tag.version
+    version = tag_index.get_best_candidate(active_version, tag_and_digest.tag.variant, max_bump_size)
+    if version is None:
+        return None
+    return ParsedTag(version=version, variant=tag_and_digest.tag.variant)
 
 def is_upgrade(from_tag_and_digest: ParsedTagAndDigest | None, to_tag: ParsedTag, to_digest: str) -> BumpSize | None:
     """Determine if an upgrade is needed and what bump size it represents"""
@@ -144,8 +222,40 @@ def is_upgrade(from_tag_and_digest: ParsedTagAndDigest | None, to_tag: ParsedTag
             return bump_size
         return None
 
-async def get_digest(image: ParsedImage, tag: ParsedTag) -> tuple[str, datetime]:
-    inspect = await skopeo.inspect(f'{image.untagged}:{tag}')
-    return inspect.digest, isoparse(inspect.created)
+async def get_digest(image: ParsedImage, tag: ParsedTag) -> str:
+    """Resolve the manifest digest of a tag, without fetching the image config"""
+    return await _digest_flights.run(f'{image.untagged}:{tag}', lambda: _get_digest(image, tag))
 
+async def get_candidate_and_digest(parsed_active_image: ParsedImage, max_bump_size: BumpSize) -> tuple[ParsedTag, str] | None:
+    """Get the best tag to move to along with its digest"""
+    tag_and_digest = parsed_active_image.tag_and_digest
+    if (not config.incremental_scan or tag_and_digest is None or isinstance(tag_and_digest.tag.version, str)
+            or tag_and_digest.tag.version.precision != SemanticVersionPrecision.PATCH):
+        # release tags like latest and rolling tags like 20 or 15.4 move to new pushes without the tag list changing,
+        # so they are always resolved
+        tag = await get_candidate_tag(parsed_active_image, max_bump_size)
+        if tag is None:
+            return None
+        return tag, await get_digest(parsed_active_image, tag)
+
+    # full version tags are rarely pushed over, so while the versions a candidate is chosen from are unchanged,
+    # the candidate and digest chosen last time still hold and neither has to be worked out again
+    tag_index = await _get_tag_index(parsed_active_image)
+    active_version = tag_and_digest.tag.version
+    variant = tag_and_digest.tag.variant
+    fingerprint = tag_index.get_fingerprint(active_version, variant)
+    lookup_key = f'{parsed_active_image.untagged}:{tag_and_digest.tag}:{int(max_bump_size)}'
+    resolved = state.resolved_candidates.get(lookup_key, fingerprint, config.incremental_scan_max_age.total_seconds())
+    if resolved is not None:
+        candidate_version, digest = resolved
+        tag = ParsedTag(version=SemanticVersion.unpack(candidate_version, active_version.version_prefix), variant=variant)
+        _logger.debug(f'Reusing candidate {tag} with digest {digest} for {parsed_active_image}, its versions are unchanged since it was resolved')
+        return tag, digest
 
+    version = tag_index.get_best_candidate(active_version, variant, max_bump_size)
+    if version is None:
+        return None
+    tag = ParsedTag(version=version, variant=variant)
+    digest = await get_digest(parsed_active_image, tag)
+    state.resolved_candidates.set(lookup_key, fingerprint, version.sort_key, digest)
+    return tag, digest
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+def encoded_size(text: str) -> int:
+    """Size of a string encoded as utf-8, which for an ascii string is its length, so it is only encoded when it is not ascii"""
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+class LruCache:
+    """Thread safe least recently used cache bounded by entry count and total size in bytes"""
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, size_bytes: int):
+        with self._lock:
+            self._remove(key)
+            if size_bytes > self.max_bytes or self.max_entries <= 0:
+                return
+            self._entries[key] = (value, size_bytes)
+            self.size_bytes += size_bytes
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import json
 from enum import Enum, IntEnum
 
 class SemanticVersionPrecision(Enum):
@@ -21,7 +22,7 @@ class SemanticVersionSize(Enum):
     DOWNGRADE = "Downgrade"
     PRECISION_MISMATCH = "PrecisionMismatch"
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class DockerComposeTarget:
     file_path: str
     service_key: str
@@ -34,7 +35,9 @@ class DockerComposeTarget:
         return f"DockerCompose:{self.file_path}:{self.service_key}"
 
 
-@dataclass(frozen=True)
+_PACKED_FIELD_MASK = (1 << 21) - 1
+
+@dataclass(frozen=True, slots=True)
 class SemanticVersion:
     major: int
     minor: int | None = None
@@ -52,6 +55,41 @@ class SemanticVersion:
                 parts.append(str(self.patch))
         return ".".join(parts)
 
+    @property
+    def sort_key(self) -> int:
+        """Packed integer key that orders the same way as the version, among versions of the same precision"""
+        return SemanticVersion.pack(self.major, self.minor, self.patch)
+
+    @staticmethod
+    def pack(major: int, minor: int | None = None, patch: int | None = None) -> int:
+        # each number is stored plus one in its own 21 bit field, leaving 0 for a missing number
+        key = (major + 1) << 42
+        if minor is not None:
+            key |= (minor + 1) << 21
+            if patch is not None:
+                key |= patch + 1
+        return key
+
+    @staticmethod
+    def unpack(key: int, version_prefix: str | None = None) -> "SemanticVersion":
+        minor = (key >> 21) & _PACKED_FIELD_MASK
+        patch = key & _PACKED_FIELD_MASK
+        return SemanticVersion(
+            major=(key >> 42) - 1,
+            minor=minor - 1 if minor else None,
+            patch=patch - 1 if patch else None,
+            version_prefix=version_prefix
+        )
+
+    @property
+    def numbers(self) -> tuple[int, ...]:
+        """The version numbers up to the version's precision, which order the same way as the versions"""
+        if self.minor is None:
+            return (self.major,)
+        if self.patch is None:
+            return (self.major, self.minor)
+        return (self.major, self.minor, self.patch)
+
     @property
     def precision(self) -> SemanticVersionPrecision:
         if self.minor is not None:
@@ -83,7 +121,7 @@ class SemanticVersion:
         return SemanticVersionSize.EQUAL
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ParsedTag:
     version: SemanticVersion | str
     variant: str | None = None
@@ -95,7 +133,7 @@ class ParsedTag:
         return base
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ParsedTagAndDigest:
     tag: ParsedTag
     digest: str | None = None
@@ -113,7 +151,7 @@ class ParsedTagAndDigest:
         return f"{self.tag}@{self.digest[:8]}"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class ParsedImage:
     name: str
     untagged: str
@@ -144,17 +182,28 @@ class ParsedImage:
         return f"{source.name}: {left} → {right}"
 
 @dataclass
-class SkopeoInspectResponse:
-    """Response from skopeo inspect command"""
-    name: str
-    digest: str
-    created: str
-    architecture: str
-    os: str
-    layers: list[str]
-    labels: dict
-    env: list[str]
-    entrypoint: list[str]
-    cmd: list[str]
-    working_dir: str
-    user: str
+class TagSet:
+    """Compact form of an image's tag list, keeping only the tags that parse as versions or releases"""
+    # (version prefix, variant) -> version numbers, with one number per level of precision
+    versions: dict[tuple[str | None, str | None], list[tuple[int, ...]]] = field(default_factory=dict)
+    # (release, variant)
+    releases: set[tuple[str, str | None]] = field(default_factory=set)
+
+    def add(self, tag: ParsedTag):
+        if isinstance(tag.version, str):
+            self.releases.add((tag.version, tag.variant))
+            return
+        self.versions.setdefault((tag.version.version_prefix, tag.variant), []).append(tag.version.numbers)
+
+    def dumps(self) -> str:
+        """Serialize as json, as [[prefix, variant, [numbers, ...]], ...] followed by [[release, variant], ...]"""
+        versions = [[prefix, variant, numbers] for (prefix, variant), numbers in self.versions.items()]
+        return json.dumps([versions, sorted(self.releases, key=repr)], separators=(',', ':'))
+
+    @staticmethod
+    def loads(data: str) -> "TagSet":
+        versions, releases = json.loads(data)
+        return TagSet(
+            versions={(prefix, variant): [tuple(n) for n in numbers] for prefix, variant, numbers in versions},
+            releases={(release, variant) for release, variant in releases}
+        )
@@ -0,0 +1,204 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import httpx
+from .models import ParsedImage
+from .state import state
+from .config import config
+from .registry_scheduler import scheduler
+
+_logger = logging.getLogger(__name__)
+
+_DOCKER_HUB_DOMAIN = 'docker.io'
+_DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+_DOCKER_HUB_AUTH_KEYS = ['docker.io', 'index.docker.io', 'registry-1.docker.io', 'https://index.docker.io/v1/']
+_TAGS_PAGE_SIZE = 1000
+
+_INDEX_MEDIA_TYPES = [
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+]
+_MANIFEST_MEDIA_TYPES = [
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+]
+_MANIFEST_ACCEPT = ', '.join(_INDEX_MEDIA_TYPES + _MANIFEST_MEDIA_TYPES)
+
+_client: httpx.AsyncClient | None = None
+_credentials: dict[str, str] | None = None
+_tokens: dict[tuple[str, str], tuple[str, float]] = {}
+
+
+class RegistryError(Exception):
+    """The registry answered in a way this client does not understand, such as an unsupported auth scheme"""
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Get the shared client, which keeps connections to each registry alive between lookups"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0),
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=config.maximum_concurrent_lookups,
+                max_keepalive_connections=config.maximum_concurrent_lookups
+            )
+        )
+    return _client
+
+
+def _get_registry_host(domain: str) -> str:
+    if domain == _DOCKER_HUB_DOMAIN:
+        return _DOCKER_HUB_REGISTRY
+    return domain
+
+
+def _get_base_url(domain: str) -> str:
+    scheme = 'http' if domain in config.insecure_registries else 'https'
+    return f'{scheme}://{_get_registry_host(domain)}'
+
+
+def _get_repository(image: ParsedImage) -> str:
+    domain = image.domain or _DOCKER_HUB_DOMAIN
+    namespace = image.namespace
+    if domain == _DOCKER_HUB_DOMAIN and not namespace:
+        namespace = 'library'
+    if namespace:
+        return f'{namespace}/{image.name}'
+    return image.name
+
+
+def _load_credentials() -> dict[str, str]:
+    """Load the base64 encoded basic auth credentials from the docker auth file"""
+    global _credentials
+    if _credentials is not None:
+        return _credentials
+
+    _credentials = {}
+    if not os.path.exists(config.docker_auth_file):
+        return _credentials
+    try:
+        with open(config.docker_auth_file, 'r') as f:
+            auths = json.load(f).get('auths', {})
+        for key, value in auths.items():
+            if 'auth' in value:
+                _credentials[key] = value['auth']
+            elif 'username' in value and 'password' in value:
+                _credentials[key] = base64.b64encode(f"{value['username']}:{value['password']}".encode()).decode('utf-8')
+    except Exception as e:
+        _logger.error(f"Failed to load registry credentials from {config.docker_auth_file}: {e}")
+    return _credentials
+
+
+def _get_credentials(domain: str) -> str | None:
+    credentials = _load_credentials()
+    keys = _DOCKER_HUB_AUTH_KEYS if domain == _DOCKER_HUB_DOMAIN else [domain, f'https://{domain}']
+    for key in keys:
+        if key in credentials:
+            return credentials[key]
+    return None
+
+
+def _parse_www_authenticate(header: str) -> tuple[str, dict[str, str]]:
+    scheme, _, params = header.partition(' ')
+    return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+
+async def _get_token(domain: str, params: dict[str, str], scope: str) -> str:
+    query = {'scope': params.get('scope', scope)}
+    if 'service' in params:
+        query['service'] = params['service']
+    headers = {}
+    credentials = _get_credentials(domain)
+    if credentials:
+        headers['Authorization'] = f'Basic {credentials}'
+
+    response = await _get_client().get(params['realm'], params=query, headers=headers)
+    response.raise_for_status()
+    data = response.json()
+    token = data.get('token') or data.get('access_token')
+    if not token:
+        raise RegistryError(f'Token endpoint {params["realm"]} did not return a token')
+    expires_in = data.get('expires_in', 60)
+    # refresh a little early so the token cannot expire mid request
+    _tokens[(domain, scope)] = (f'Bearer {token}', time.time() + max(0, expires_in - 10))
+    return f'Bearer {token}'
+
+
+async def _request(method: str, image: ParsedImage, path: str, headers: dict[str, str] | None = None) -> httpx.Response:
+    """Send a request to the registry, authenticating if challenged"""
+    domain = image.domain or _DOCKER_HUB_DOMAIN
+    scope = f'repository:{_get_repository(image)}:pull'
+    url = path if path.startswith('http') else f'{_get_base_url(domain)}{path}'
+    headers = dict(headers or {})
+
+    cached = _tokens.get((domain, scope))
+    if cached is not None and cached[1] > time.time():
+        headers['Authorization'] = cached[0]
+
+    response = await _get_client().request(method, url, headers=headers)
+    if response.status_code == 401 and 'www-authenticate' in response.headers:
+        auth_scheme, params = _parse_www_authenticate(response.headers['www-authenticate'])
+        if auth_scheme == 'bearer' and 'realm' in params:
+            headers['Authorization'] = await _get_token(domain, params, scope)
+        elif auth_scheme == 'basic':
+            if not (credentials := _get_credentials(domain)):
+                response.raise_for_status()
+            headers['Authorization'] = f'Basic {credentials}'
+        else:
+            raise RegistryError(f'Unsupported auth scheme {auth_scheme} for {domain}')
+        response = await _get_client().request(method, url, headers=headers)
+
+    response.raise_for_status()
+    return response
+
+
+async def list_tags(image: ParsedImage, use_cache: bool = True) -> list[str]:
+    """List all available tags for an image, following pagination"""
+    repository = _get_repository(image)
+    cache_args = ['list-tags', f'{image.domain}/{repository}']
+    if use_cache:
+        cached_result = state.skopeo_cache.get('registry', cache_args)
+        if cached_result is not None:
+            _logger.debug(f"Using cached tag list for {image.untagged}")
+            return cached_result.split('\n') if cached_result else []
+
+    tags: list[str] = []
+    async with scheduler.slot(image.domain):
+        path = f'/v2/{repository}/tags/list?n={_TAGS_PAGE_SIZE}'
+        while path:
+            response = await _request('GET', image, path)
+            tags.extend(response.json().get('tags') or [])
+            next_link = response.links.get('next', {}).get('url')
+            path = str(response.url.join(next_link)) if next_link else None
+
+    _logger.debug(f"Found {len(tags)} tags for {image.untagged}")
+    if use_cache:
+        state.skopeo_cache.set('registry', cache_args, '\n'.join(tags))
+    return tags
+
+
+async def get_digest(image: ParsedImage, tag: str) -> str:
+    """Get the manifest digest for a tag using a HEAD request"""
+    repository = _get_repository(image)
+    cache_args = ['digest', f'{image.domain}/{repository}:{tag}']
+    cached_result = state.skopeo_cache.get('registry', cache_args)
+    if cached_result is not None:
+        return cached_result
+
+    path = f'/v2/{repository}/manifests/{tag}'
+    async with scheduler.slot(image.domain):
+        response = await _request('HEAD', image, path, {'Accept': _MANIFEST_ACCEPT})
+        digest = response.headers.get('docker-content-digest')
+        if not digest:
+            # not every registry sends the digest on HEAD requests
+            response = await _request('GET', image, path, {'Accept': _MANIFEST_ACCEPT})
+            digest = response.headers.get('docker-content-digest') or f'sha256:{hashlib.sha256(response.content).hexdigest()}'
+
+    state.skopeo_cache.set('registry', cache_args, digest)
+    return digest
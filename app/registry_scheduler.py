@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from .config import config
+
+_logger = logging.getLogger(__name__)
+
+class RegistryScheduler:
+    """Limits concurrent registry lookups globally and per registry domain.
+
+    Waiters are granted slots in the order they arrived, skipping over any whose
+    registry is currently saturated so one busy registry cannot stall the others.
+    """
+    def __init__(self, global_limit: int, domain_limit: int, domain_limits: dict[str, int] | None = None):
+        self.global_limit = max(1, global_limit)
+        self.domain_limit = max(1, domain_limit)
+        self.domain_limits = {k: max(1, v) for k, v in (domain_limits or {}).items()}
+        self._active = 0
+        self._active_by_domain: dict[str | None, int] = {}
+        self._waiters: deque[tuple[str | None, asyncio.Future]] = deque()
+
+    def _get_domain_limit(self, domain: str | None) -> int:
+        if domain is None:
+            return self.domain_limit
+        return self.domain_limits.get(domain, self.domain_limit)
+
+    def _can_start(self, domain: str | None) -> bool:
+        return self._active < self.global_limit and \
+            self._active_by_domain.get(domain, 0) < self._get_domain_limit(domain)
+
+    def _take(self, domain: str | None):
+        self._active += 1
+        self._active_by_domain[domain] = self._active_by_domain.get(domain, 0) + 1
+
+    def _release(self, domain: str | None):
+        self._active -= 1
+        remaining = self._active_by_domain[domain] - 1
+        if remaining:
+            self._active_by_domain[domain] = remaining
+        else:
+            del self._active_by_domain[domain]
+        self._wake()
+
+    def _wake(self):
+        remaining: deque[tuple[str | None, asyncio.Future]] = deque()
+        while self._waiters:
+            if self._active >= self.global_limit:
+                remaining.extend(self._waiters)
+                break
+            domain, future = self._waiters.popleft()
+            if future.done():
+                continue
+            if self._can_start(domain):
+                self._take(domain)
+                future.set_result(None)
+            else:
+                remaining.append((domain, future))
+        self._waiters = remaining
+
+    async def _acquire(self, domain: str | None):
+        if self._can_start(domain):
+            self._take(domain)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((domain, future))
+        _logger.debug(f"Waiting for registry slot for {domain} ({len(self._waiters)} waiting)")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed to us right before we were cancelled
+                self._release(domain)
+            raise
+
+    @asynccontextmanager
+    async def slot(self, domain: str | None):
+        """Hold one lookup slot for the given registry domain"""
+        await self._acquire(domain)
+        try:
+            yield
+        finally:
+            self._release(domain)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, f in self._waiters if not f.done())
+
+
+scheduler = RegistryScheduler(
+    config.maximum_concurrent_lookups,
+    config.maximum_concurrent_lookups_per_registry,
+    config.registry_concurrency_limits
+)
@@ -3,117 +3,253 @@ from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse, Response, FileResponse
 from fastapi.staticfiles import StaticFiles
 import logging
-from .state import state
+from .state import state, CommitInfo
 import asyncio
 from .config import config
 from . import gitlab
 from . import jinja_filters
 import os
 import html
+import math
+import threading
+import secrets
+from collections import deque
+from .lru_cache import LruCache, encoded_size
 
 _logger = logging.getLogger(__name__)
 
+_log_levels = [
+    ("[INFO]", "has-text-info"),
+    ("[WARNING]", "has-text-warning"),
+    ("[ERROR]", "has-text-danger"),
+    ("[DEBUG]", "has-text-grey")
+]
+
+def _format_log_line(msg: str) -> str:
+    for level, color_class in _log_levels:
+        if level in msg:
+            parts = msg.split(level, 1)
+            if len(parts) == 2:
+                before_level, after_level = parts
+                level, before_level, after_level = html.escape(level), html.escape(before_level), html.escape(after_level)
+                return f"""<div><span>{before_level}</span><span class="{color_class}">{level}</span><span>{after_level}</span></div>"""
+            break
+
+    # No log level found, use default format
+    return f"<div>{html.escape(msg)}</div>"
+
+class _Client:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task | None = None
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    """Streams log lines to every websocket. Lines are buffered and sent as a single fragment per flush interval,
+    and each connection is written by its own task from its own bounded queue, so a slow client never holds up the rest"""
+    def __init__(self, flush_interval: float, queue_size: int, max_buffered_lines: int):
+        self.active_connections: dict[WebSocket, _Client] = {}
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        # lines can be pushed from any thread, so they are only handed to the event loop at flush time
+        self._lines: deque[str] = deque(maxlen=max_buffered_lines)
+        self._lines_lock = threading.Lock()
+        self._dropped_lines = 0
+        self._flusher: asyncio.Task | None = None
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = _Client(websocket, self.queue_size)
+        client.writer = asyncio.create_task(self._write(client))
+        with state.broadcaster.replay() as history, self._lines_lock:
+            self.active_connections[websocket] = client
+            # the newest lines are still buffered and go out with the next flush
+            history = history[:len(history) - len(self._lines)]
+        if history:
+            client.queue.put_nowait(self._fragment(''.join(_format_log_line(msg) for msg in history)))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
         client_ip = getattr(websocket.client, 'host', None)
         _logger.info(f'New WS connection: {client_ip}')
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.active_connections.pop(websocket, None)
+        if client is None:
+            return
+        if client.writer is not None:
+            client.writer.cancel()
         client_ip = getattr(websocket.client, 'host', None)
         _logger.info(f'WS disconnected: {client_ip}')
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
+    def push(self, line: str):
+        """Buffer a line for the next flush. Safe to call from any thread"""
+        if not self.active_connections:
+            return
+        with self._lines_lock:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped_lines += 1
+            self._lines.append(line)
+
+    async def _write(self, client: _Client):
+        try:
+            while True:
+                message = await client.queue.get()
+                await client.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Remove dead connections
+            self.disconnect(client.websocket)
+
+    async def _flush_periodically(self):
+        while self.active_connections:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Send everything buffered since the last flush to every client as one fragment"""
+        with self._lines_lock:
+            if not self._lines:
+                return
+            lines = ''.join(self._lines)
+            dropped, self._dropped_lines = self._dropped_lines, 0
+            self._lines.clear()
+        if dropped:
+            lines = f"<div class='has-text-grey'>... {dropped} lines skipped ...</div>{lines}"
+        self.broadcast(self._fragment(lines))
+
+    @staticmethod
+    def _fragment(lines: str) -> str:
+        return f"<div id='scan-output' hx-swap-oob='beforeend'>{lines}</div>"
+
+    def broadcast(self, message: str):
+        for websocket, client in list(self.active_connections.items()):
             try:
-                await connection.send_text(message)
-            except:
-                # Remove dead connections
-                self.active_connections.remove(connection)
+                client.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # the client has fallen too far behind to catch up, so let it reconnect instead
+                _logger.warning(f'Dropping WS connection {getattr(websocket.client, "host", None)} that is not keeping up')
+                self.disconnect(websocket)
+                asyncio.create_task(self._close(websocket))
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+_UPDATE_HISTORY_CACHE_PAGES = 32
+_UPDATE_HISTORY_CACHE_BYTES = 4 * 1024 * 1024
+# the commit version restarts with the process, so etags also carry a value unique to this process
+_boot_nonce = secrets.token_hex(4)
+
+def _format_cursor(commit_info: CommitInfo) -> str:
+    return f"{commit_info.commit_timestamp!r}_{commit_info.commit_hash}"
+
+def _parse_cursor(value: str) -> tuple[float, str] | None:
+    timestamp, _, commit_hash = value.partition("_")
+    try:
+        parsed_timestamp = float(timestamp)
+    except ValueError:
+        return None
+    if not math.isfinite(parsed_timestamp) or not commit_hash.isalnum():
+        return None
+    return parsed_timestamp, commit_hash
+
+def _get_page_params(request: Request) -> tuple[int, tuple[float, str] | None, bool]:
+    """Get the page size, the cursor and whether to page towards newer commits from the query"""
+    params = request.query_params
+    per_page = int(params.get("per_page", config.default_update_history_page_size))
+    per_page = max(1, min(100, per_page))  # Limit per_page between 1 and 100
+    if "before" in params:
+        cursor = _parse_cursor(params["before"])
+        # a malformed cursor falls back to the newest page
+        return per_page, cursor, cursor is not None
+    if "after" in params:
+        return per_page, _parse_cursor(params["after"]), False
+    return per_page, None, params.get("last") == "1"
+
+def _get_update_history_etag(per_page: int, cursor: tuple[float, str] | None, newer: bool, version: int | None = None) -> str:
+    if version is None:
+        version = state.commit.version
+    cursor_key = f"{cursor[0]!r}_{cursor[1]}" if cursor else ""
+    return f'W/"{_boot_nonce}-{version}-{per_page}-{int(newer)}-{cursor_key}"'
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    """Check an etag against the list in an If-None-Match header, where a weak and a strong tag with the same value match"""
+    opaque_tag = etag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == opaque_tag:
+            return True
+    return False
 
 def add_routes(app: FastAPI):
     templates = Jinja2Templates(directory="app/templates")
     jinja_filters.add_filters(templates)
-    manager = ConnectionManager()
+    manager = ConnectionManager(config.ws_flush_interval, config.ws_client_queue_size, config.ws_max_buffered_lines)
 
-    def broadcaster_listener(msg: str):
-        nonlocal manager
-        log_levels = [
-            ("[INFO]", "has-text-info"),
-            ("[WARNING]", "has-text-warning"),
-            ("[ERROR]", "has-text-danger"),
-            ("[DEBUG]", "has-text-grey")
-        ]
-
-        for level, color_class in log_levels:
-            if level in msg:
-                parts = msg.split(level, 1)
-                if len(parts) == 2:
-                    before_level, after_level = parts
-                    level, before_level, after_level = html.escape(level), html.escape(before_level), html.escape(after_level)
-                    text = f"""
-                        <div id='scan-output' hx-swap-oob='beforeend'>
-                            <div><span>{before_level}</span><span class="{color_class}">{level}</span><span>{after_level}</span></div>
-                        </div>
-                    """
-                else:
-                    msg = html.escape(msg)
-                    text = f"""
-                        <div id='scan-output' hx-swap-oob='beforeend'>
-                            <div>{msg}</div>
-                        </div>
-                    """
-                asyncio.create_task(manager.broadcast(text))
-                return
+    # rendered history pages, thrown away whenever a commit is written
+    update_history_cache = LruCache(_UPDATE_HISTORY_CACHE_PAGES, _UPDATE_HISTORY_CACHE_BYTES)
+    update_history_cache_version = -1
+
+    def render_update_history(per_page: int, cursor: tuple[float, str] | None, newer: bool) -> tuple[str, str]:
+        """Render a page of the update history, returning its etag and html"""
+        nonlocal update_history_cache_version
+        version = state.commit.version
+        if version != update_history_cache_version:
+            update_history_cache.clear()
+            update_history_cache_version = version
+        etag = _get_update_history_etag(per_page, cursor, newer, version)
+        cached = update_history_cache.get(etag)
+        if cached is not None:
+            return etag, cached
 
-        # No log level found, use default format
-        text = f"""
-            <div id='scan-output' hx-swap-oob='beforeend'>
-                <div>{msg}</div>
-            </div>
-        """
-        asyncio.create_task(manager.broadcast(text))
+        commits, has_more = state.commit.items(per_page=per_page, cursor=cursor, newer=newer)
+        # there is always something on the side the cursor came from
+        has_newer = has_more if newer else cursor is not None
+        has_older = cursor is not None if newer else has_more
+        update_history = templates.get_template("update_history.html").render(
+            commits=commits,
+            pagination={
+                "per_page": per_page,
+                "total_count": len(state.commit),
+                "has_newer": has_newer and bool(commits),
+                "has_older": has_older and bool(commits),
+                "newer_cursor": _format_cursor(commits[0][1]) if commits else None,
+                "older_cursor": _format_cursor(commits[-1][1]) if commits else None
+            }
+        )
+        update_history_cache.set(etag, update_history, encoded_size(update_history))
+        return etag, update_history
+
+    def broadcaster_listener(msg: str):
+        if manager.active_connections:
+            manager.push(_format_log_line(msg))
     state.broadcaster.register(broadcaster_listener)
 
     @app.get("/", response_class=HTMLResponse)
     async def root(request: Request):
-        # Get pagination parameters
-        page = int(request.query_params.get("page", 1))
-        per_page = int(request.query_params.get("per_page", config.default_update_history_page_size))
-        
-        # Ensure page is at least 1
-        page = max(1, page)
-        per_page = max(1, min(100, per_page))  # Limit per_page between 1 and 100
-        
-        # Get paginated commits
-        commits, total_count = state.commit.items(page=page, per_page=per_page)
-        
-        # Calculate pagination info
-        total_pages = (total_count + per_page - 1) // per_page
-        has_prev = page > 1
-        has_next = page < total_pages
-        
+        _, update_history = render_update_history(*_get_page_params(request))
         return templates.TemplateResponse("index.html", {
             "request": request, 
             "state": state,
-            "commits": commits,
-            "pagination": {
-                "page": page,
-                "per_page": per_page,
-                "total_count": total_count,
-                "total_pages": total_pages,
-                "has_prev": has_prev,
-                "has_next": has_next,
-                "prev_page": page - 1 if has_prev else None,
-                "next_page": page + 1 if has_next else None
-            }
+            "update_history": update_history
         })
 
+    @app.get("/fragments/update-history", response_class=HTMLResponse)
+    async def update_history_fragment(request: Request):
+        page_params = _get_page_params(request)
+        etag = _get_update_history_etag(*page_params)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        # polling dashboards revalidate with the etag, which is answered without touching the database
+        if _etag_matches(etag, request.headers.get("if-none-match", "")):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        etag, update_history = render_update_history(*page_params)
+        headers["ETag"] = etag
+        return HTMLResponse(update_history, headers=headers)
+
     @app.post("/api/webhooks/gitlab", response_class=HTMLResponse)
     async def gitlab_webhook(request: Request):
         auth = request.headers.get("authorization")
@@ -139,6 +275,8 @@ def add_routes(app: FastAPI):
             while True:
                 _ = await websocket.receive_text()
         except WebSocketDisconnect:
+            pass
+        finally:
             manager.disconnect(websocket)
 
 
@@ -146,6 +284,10 @@ def add_routes(app: FastAPI):
     async def health_check():
         return "OK"
 
+    @app.get("/api/stats/skopeo-cache")
+    async def skopeo_cache_stats():
+        return state.skopeo_cache.stats()
+
     @app.post("/run-scan")
     async def force_start_scan(request: Request):
         await state.scanner_message_queue.put("scan_now")
@@ -1,6 +1,7 @@
 import logging
 import asyncio
 import time
+from contextlib import aclosing
 from dataclasses import replace
 
 from .models import DockerComposeTarget, ParsedImage, ParsedTagAndDigest
@@ -10,15 +11,34 @@ from . import image_parser
 from . import skopeo
 from . import config
 from . import talaria_git as git
-from .state import CommitInfo, PipelineStatus, state
+from .state import CommitInfo, PendingUpdate, PipelineStatus, state
 from . import docker_compose_file
 _logger = logging.getLogger(__name__)
 
 def start():
     _logger.info("Starting scanner...")
     asyncio.create_task(_start())
+    asyncio.create_task(_maintain())
     _logger.info("Scanner started.")
 
+async def _maintain():
+    interval = config.cache_maintenance_interval.total_seconds()
+    while True:
+        try:
+            await asyncio.to_thread(_run_maintenance)
+        except Exception as e:
+            _logger.exception(f"Cache maintenance failed. {type(e).__name__}: {e}")
+        await asyncio.sleep(interval)
+
+def _run_maintenance():
+    # access times go in first, so eviction does not take entries that have only been hit in memory
+    state.skopeo_cache.flush_access_times()
+    expired = state.skopeo_cache.cleanup_expired(config.cache_maintenance_batch_size)
+    evicted = state.skopeo_cache.enforce_size_limit(config.skopeo_cache_max_size, config.cache_maintenance_batch_size)
+    resolved = state.resolved_candidates.cleanup_expired(config.incremental_scan_max_age.total_seconds())
+    state.incremental_vacuum(config.db_incremental_vacuum_pages)
+    _logger.debug(f"Cache maintenance removed {expired} expired and {evicted} evicted skopeo cache entries, and {resolved} expired resolved candidates")
+
 async def _start():
     delay = config.update_delay.total_seconds()
 
@@ -41,75 +61,181 @@ async def _start():
             _logger.info("Scheduled scan triggered by timeout.")
             await _run_scan(delay)
 
-async def _run_scan(delay):
-    try:
-        _logger.info("Running scan...")
+async def _check_target(target: DockerComposeTarget) -> PendingUpdate | None:
+    parsed_image = image_parser.try_parse(target.current_image_string)
+    if not parsed_image:
+        _logger.warn(f'Failed to parse image {target.current_image_string}')
+        return
 
-        repo = git.TalariaGit()
-        repo.delete()
-        await repo.clone()
-        await repo.setup_environment()
+    _logger.info(f'Checking for updates for {parsed_image}')
 
-        docker_compose_files: list[str] = docker_compose_file.get_docker_compose_files()
-        targets: list[DockerComposeTarget] = []
-        for file in docker_compose_files:
-            potential_targets, errors = docker_compose_file.get_images(file)
+    candidate = await image_updater.get_candidate_and_digest(parsed_image, target.bump)
+    if candidate is None:
+        _logger.debug(f'Found no candidate tags for target {parsed_image} with bump size {target.bump}.')
+        return
+
+    desired_tag, digest = candidate
+    _logger.debug(f'Using desired tag {desired_tag} for target {parsed_image} with bump size {target.bump}.')
+    bump_size = image_updater.is_upgrade(parsed_image.tag_and_digest, desired_tag, digest)
+    if bump_size is None:
+        _logger.debug(f'Determined desired tag {desired_tag} with digest {digest} for target {parsed_image} is not an upgrade.')
+        return 
+
+    new_image = replace(parsed_image, 
+        tag_and_digest=ParsedTagAndDigest(
+            tag=desired_tag,
+            digest=digest
+        )
+    )
+    change = ParsedImage.diff_string(parsed_image, new_image.tag_and_digest)
+    _logger.info(f'Found upgrade {change}')
+    return PendingUpdate(
+        file_path=target.file_path,
+        line=target.line,
+        service_key=target.service_key,
+        current_image_string=target.current_image_string,
+        new_image_string=str(new_image),
+        change=change,
+        bump_size=bump_size,
+        discovered_at=time.time()
+    )
+
+async def _discover(targets: asyncio.Queue, file_hashes: dict[str, str] | None, workers: int):
+    """Feed targets to the lookup workers as files are parsed, waiting whenever the queue is full"""
+    # closing explicitly stops the walk as soon as this stage is cancelled, rather than whenever the generator is collected
+    async with aclosing(docker_compose_file.discover_targets(file_hashes)) as discovered:
+        async for file, potential_targets, errors in discovered:
             for error in errors:
                 _logger.warning(f'Unable to parse docker compose file image in file {file}: {error}')
             for target in potential_targets:
                 if target.skip:
                     _logger.info(f'Skipping image {target.service_key} due to configured skip')
                 else:
-                    targets.append(target)
-
-        async def update_target(target) -> tuple[DockerComposeTarget, ParsedImage, ParsedImage] | None:
-            parsed_image = image_parser.try_parse(target.current_image_string)
-            if not parsed_image:
-                _logger.warn(f'Failed to parse image {target.current_image_string}')
-                return
-
-            _logger.info(f'Checking for updates for {parsed_image}')
-
-            candidate_tags = await image_updater.get_sorted_candidate_tags(parsed_image, target.bump)
-            _logger.debug(f'Found {len(candidate_tags)} candidate tags for target {parsed_image} with bump size {target.bump}.')
-            if len(candidate_tags) == 0:
-                return
-
-            desired_tag = candidate_tags[0]
-            _logger.debug(f'Using desired tag {desired_tag} for target {parsed_image} with bump size {target.bump}.')
-            digest, created = await image_updater.get_digest(parsed_image, desired_tag)
-            if image_updater.is_upgrade(parsed_image.tag_and_digest, desired_tag, digest) is None:
-                _logger.debug(f'Determined desired tag {desired_tag} with digest {digest} for target {parsed_image} is not an upgrade.')
-                return 
-
-            new_image = replace(parsed_image, 
-                tag_and_digest=ParsedTagAndDigest(
-                    tag=desired_tag,
-                    digest=digest
-                )
-            )
-            _logger.info(f'Found upgrade {ParsedImage.diff_string(parsed_image, new_image.tag_and_digest)}')
-            return (target, parsed_image, new_image)
+                    await targets.put(target)
+    for _ in range(workers):
+        await targets.put(None)
+
+async def _resolve(targets: asyncio.Queue, queued_keys: set[tuple[str, int]], results: list[PendingUpdate], refreshed: list[PendingUpdate], limit: int, limit_reached: asyncio.Event):
+    """Look up targets until discovery is over, collecting upgrades until limit new ones have been found.
+    Targets with a queued upgrade are looked up again so the queue holds their latest upgrade, but they do not count towards limit"""
+    while (target := await targets.get()) is not None:
+        result = await _check_target(target)
+        if result is None or limit_reached.is_set():
+            continue
+        if (target.file_path, target.line) in queued_keys:
+            refreshed.append(result)
+            continue
+        results.append(result)
+        if len(results) >= limit:
+            limit_reached.set()
+
+async def _find_updates(file_hashes: dict[str, str] | None, limit: int, queued_keys: set[tuple[str, int]]) -> tuple[list[PendingUpdate], list[PendingUpdate]]:
+    """Run discovery and lookups as concurrent stages joined by a bounded queue, stopping both once limit new upgrades are found.
+    Returns the new upgrades and the fresh upgrades for targets that were already queued"""
+    targets: asyncio.Queue[DockerComposeTarget | None] = asyncio.Queue(maxsize=config.scan_queue_size)
+    results: list[PendingUpdate] = []
+    refreshed: list[PendingUpdate] = []
+    limit_reached = asyncio.Event()
+    if limit <= 0:
+        limit_reached.set()
 
-        get_updates_tasks = [update_target(t) for t in targets]
-        results = await asyncio.gather(*get_updates_tasks)
-        results = [i for i in results if i is not None]
+    workers = max(1, config.maximum_concurrent_lookups)
+    tasks = [asyncio.create_task(_discover(targets, file_hashes, workers))]
+    tasks += [asyncio.create_task(_resolve(targets, queued_keys, results, refreshed, limit, limit_reached)) for _ in range(workers)]
+    limit_reached_task = asyncio.create_task(limit_reached.wait())
+    try:
+        pending = set(tasks)
+        while pending and not limit_reached.is_set():
+            done, pending = await asyncio.wait(pending | {limit_reached_task}, return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(limit_reached_task)
+            for task in done:
+                if task is not limit_reached_task:
+                    # raises the first error hit by any stage
+                    task.result()
+        if limit_reached.is_set():
+            _logger.info(f'Found {limit} new updates, skipping the remaining lookups.')
+    finally:
+        for task in tasks + [limit_reached_task]:
+            task.cancel()
+        await asyncio.gather(*tasks, limit_reached_task, return_exceptions=True)
+
+    return results, refreshed
+
+def _take_pending_updates(limit: int) -> list[tuple[DockerComposeTarget, PendingUpdate]]:
+    """Get the next pending upgrades whose image line is unchanged since they were found, dropping the ones that are stale"""
+    taken: list[tuple[DockerComposeTarget, PendingUpdate]] = []
+    offset = 0
+    while len(taken) < limit:
+        candidates = state.pending_updates.peek(limit - len(taken), offset)
+        if not candidates:
+            break
+
+        stale = []
+        targets_by_file: dict[str, dict[int, DockerComposeTarget]] = {}
+        for update in candidates:
+            if update.file_path not in targets_by_file:
+                try:
+                    targets, _ = docker_compose_file.get_images(update.file_path)
+                except OSError:
+                    targets = []
+                targets_by_file[update.file_path] = {target.line: target for target in targets}
+            target = targets_by_file[update.file_path].get(update.line)
+            # the image, and the bump size or skip it was configured with, must not have changed since the upgrade was found
+            if target is None or target.current_image_string != update.current_image_string or target.skip or target.bump < update.bump_size:
+                _logger.info(f'Dropping stale pending upgrade {update.change} in {update.file_path}')
+                stale.append(update)
+            else:
+                taken.append((target, update))
 
-        _logger.info(f'Found {len(results)} updates. Taking the first {config.maximum_concurrent_pushes}.')
-        results = results[:config.maximum_concurrent_pushes]
+        if stale:
+            state.pending_updates.remove(stale)
+        offset += len(candidates) - len(stale)
+    return taken
+
+async def _run_scan(delay):
+    try:
+        state.broadcaster.clear_history()
+        _logger.info("Running scan...")
+        image_updater.reset_tag_indexes()
 
-        if len(results) > 0:
+        repo = git.TalariaGit()
+        await repo.sync()
+        await repo.setup_environment()
+
+        pending_updates = state.pending_updates
+        expired = pending_updates.remove_expired(config.pending_update_max_age.total_seconds())
+        if expired:
+            _logger.info(f'Dropped {expired} pending updates older than {config.pending_update_max_age}')
+
+        budget = config.maximum_concurrent_pushes
+        # every scan looks for at least a push worth of new upgrades, so a full queue never hides newly released ones
+        # queued targets are looked up again on the way, replacing their upgrade and priority with the latest
+        # lookups start as soon as each file is parsed, while the rest of the repository is still being searched
+        file_hashes = await repo.get_file_hashes() if config.docker_compose_parse_cache else None
+        limit = max(budget, budget + max(0, config.pending_updates_limit) - len(pending_updates))
+        results, refreshed = await _find_updates(file_hashes, limit, pending_updates.keys())
+        _logger.info(f'Found {len(results)} new updates, and refreshed {len(refreshed)} pending updates.')
+        pending_updates.add(results + refreshed)
+
+        updates = await asyncio.to_thread(_take_pending_updates, budget)
+        _logger.info(f'Applying {len(updates)} updates, {max(0, len(pending_updates) - len(updates))} remain pending.')
+
+        if len(updates) > 0:
             _logger.info('Applying changes to git repo')
+            applied = await asyncio.to_thread(docker_compose_file.apply_updates, [(target, update.new_image_string) for (target, update) in updates])
+            applied_ids = {id(target) for target in applied}
+            pending_updates.remove([update for (target, update) in updates if id(target) not in applied_ids])
+            updates = [(target, update) for (target, update) in updates if id(target) in applied_ids]
+
+        if len(updates) > 0:
             commit_title = "[talaria] Updating images"
-            changes = []
-            for (target, old_image, new_image) in results:
-                docker_compose_file.apply_update(target, str(new_image))
-                changes.append(ParsedImage.diff_string(old_image, new_image.tag_and_digest))
-            commit_body = '\n'.join(changes)
+            commit_body = '\n'.join(update.change for (_, update) in updates)
 
             await repo.add()
             await repo.commit(commit_title, commit_body)
             await repo.push()
+            # only forget the upgrades once they are pushed, so a failed push retries them next scan
+            pending_updates.remove([update for (_, update) in updates])
 
             sha = await repo.get_current_commit()
             state.commit[sha] = CommitInfo(
@@ -123,8 +249,15 @@ async def _run_scan(delay):
                 pipeline_duration=None
             )
 
+        _logger.debug(f"Skopeo cache stats: {state.skopeo_cache.stats()}")
         _logger.info("Scan complete.")
     except Exception as e:
         _logger.exception(f"Scan failed. {type(e).__name__}: {e}")
     finally:
+        # the queue is trimmed even when the scan fails after adding to it, so a failing push cannot grow it without bound
+        try:
+            state.pending_updates.trim(config.pending_updates_limit)
+        except Exception as e:
+            _logger.exception(f"Trimming pending updates failed. {type(e).__name__}: {e}")
+        image_updater.reset_tag_indexes()
         state.next_run = time.time() + delay
@@ -0,0 +1,32 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+_logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single in-flight call"""
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        # shield so that one caller being cancelled does not cancel the call for everyone else
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # retrieve the exception here, since when every caller was cancelled nobody else will,
+        # and asyncio would log it as never retrieved
+        if not future.cancelled() and (e := future.exception()) is not None:
+            _logger.debug(f'Call for {key} failed. {type(e).__name__}: {e}')
+
+    def __len__(self) -> int:
+        return len(self._calls)
@@ -4,9 +4,10 @@ import logging
 import asyncio
 import os
 import base64
-from .models import SkopeoInspectResponse
+import hashlib
 from .state import state
 from .config import config
+from .registry_scheduler import scheduler
 
 _logger = logging.getLogger(__name__)
 
@@ -47,77 +48,73 @@ def _setup_docker_auth():
 _setup_docker_auth()
 
 
-async def _run_skopeo_async(*args) -> str:
-    """Run a skopeo command asynchronously and return the result"""
-    # Check cache first
-    cached_result = state.skopeo_cache.get('skopeo', list(args))
-    if cached_result is not None:
-        _logger.debug(f"Using cached result for skopeo command: {' '.join(['skopeo'] + list(args))}")
-        return cached_result
-    
-    # Run the command if not cached
-    cmd = ['skopeo'] + list(args)
+async def _exec_skopeo_async(args: list[str], domain: str | None = None) -> bytes:
+    """Run a skopeo command asynchronously and return its raw output"""
+    cmd = ['skopeo'] + args
     
     # Add auth file if Docker credentials are configured
     if config.docker_username and config.docker_password and os.path.exists(config.docker_auth_file):
         cmd.extend(['--authfile', config.docker_auth_file])
     
-    _logger.debug(f"Running skopeo command async: {' '.join(cmd)}")
-    
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    
-    stdout, stderr = await process.communicate()
+    async with scheduler.slot(domain):
+        _logger.debug(f"Running skopeo command async: {' '.join(cmd)}")
+
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+
+        stdout, stderr = await process.communicate()
     
     if process.returncode != 0:
         _logger.error(f"Skopeo command failed: {stderr}")
         raise subprocess.CalledProcessError(process.returncode or 1, cmd, stdout, stderr)
+
+    return stdout
+
+async def _run_skopeo_async(*args, domain: str | None = None, use_cache: bool = True) -> str:
+    """Run a skopeo command asynchronously and return the result"""
+    # Check cache first
+    if use_cache:
+        cached_result = state.skopeo_cache.get('skopeo', list(args))
+        if cached_result is not None:
+            _logger.debug(f"Using cached result for skopeo command: {' '.join(['skopeo'] + list(args))}")
+            return cached_result
     
+    # Run the command if not cached
+    stdout = await _exec_skopeo_async(list(args), domain)
     result = stdout.strip().decode('utf-8')
     
     # Cache the result
-    state.skopeo_cache.set('skopeo', list(args), result)
+    if use_cache:
+        state.skopeo_cache.set('skopeo', list(args), result)
     
     return result
 
-async def inspect(image: str) -> SkopeoInspectResponse:
-    """Inspect an image and return detailed information"""
+async def get_digest(image: str, domain: str | None = None) -> str:
+    """Get the manifest digest of an image without fetching its config or layers"""
+    args = ['inspect', '--raw', f'docker://{image}']
+    cached_result = state.skopeo_cache.get('skopeo-digest', args)
+    if cached_result is not None:
+        _logger.debug(f"Using cached digest for {image}")
+        return cached_result
+
     try:
-        output = await _run_skopeo_async('inspect', f'docker://{image}')
-        data = json.loads(output)
-        
-        inspect_response = SkopeoInspectResponse(
-            name=data.get('Name', ''),
-            digest=data.get('Digest', ''),
-            created=data.get('Created', ''),
-            architecture=data.get('Architecture', ''),
-            os=data.get('Os', ''),
-            layers=data.get('Layers', []),
-            labels=data.get('Labels', {}),
-            env=data.get('Env', []),
-            entrypoint=data.get('Entrypoint', []),
-            cmd=data.get('Cmd', []),
-            working_dir=data.get('WorkingDir', ''),
-            user=data.get('User', '')
-        )
-        
-        _logger.debug(f"Inspected image: {image}")
-        return inspect_response
-        
-    except json.JSONDecodeError as e:
-        _logger.error(f"Failed to parse skopeo inspect output for {image}: {e}")
-        raise
+        # the digest is the hash of the manifest exactly as the registry serves it, so it must not be stripped
+        manifest = await _exec_skopeo_async(args, domain)
     except Exception as e:
-        _logger.error(f"Failed to inspect image {image}: {e}")
+        _logger.error(f"Failed to get digest for image {image}: {e}")
         raise
 
-async def list_tags(image: str) -> list[str]:
+    digest = f'sha256:{hashlib.sha256(manifest).hexdigest()}'
+    state.skopeo_cache.set('skopeo-digest', args, digest)
+    return digest
+
+async def list_tags(image: str, domain: str | None = None, use_cache: bool = True) -> list[str]:
     """List all available tags for an image asynchronously"""
     try:
-        output = await _run_skopeo_async('list-tags', f'docker://{image}')
+        output = await _run_skopeo_async('list-tags', f'docker://{image}', domain=domain, use_cache=use_cache)
         data = json.loads(output)
         
         tags = data.get('Tags', [])
@@ -1,15 +1,22 @@
-import json
 import asyncio
 import hashlib
 import threading
 import random
-from dataclasses import dataclass, asdict
+import logging
+from collections import deque
+from collections.abc import Container
+from contextlib import contextmanager
+from dataclasses import dataclass
 from .config import config
+from .lru_cache import LruCache, encoded_size
+from .models import BumpSize
 from enum import Enum
 import sqlite3
 import queue
 import time
 
+_logger = logging.getLogger(__name__)
+
 class PipelineStatus(str, Enum):
     UNKNOWN = "unknown"
     SUCCESS = "success"
@@ -26,21 +33,62 @@ class CommitInfo:
     pipeline_timestamp: float | None
     pipeline_duration: float | None
 
+_COMMIT_COLUMN_TYPES = {
+    'commit_short_hash': 'TEXT',
+    'commit_url': 'TEXT',
+    'pipeline_url': 'TEXT',
+    'pipeline_status': 'TEXT',
+    'commit_timestamp': 'REAL',
+    'pipeline_timestamp': 'REAL',
+    'pipeline_duration': 'REAL',
+}
+_COMMIT_COLUMNS = 'commit_hash, commit_short_hash, commit_url, pipeline_url, pipeline_status, commit_timestamp, pipeline_timestamp, pipeline_duration'
+
+def _commit_from_row(row: tuple) -> CommitInfo:
+    commit_hash, commit_short_hash, commit_url, pipeline_url, pipeline_status, commit_timestamp, pipeline_timestamp, pipeline_duration = row
+    return CommitInfo(commit_hash, commit_short_hash, commit_url, pipeline_url, PipelineStatus(pipeline_status),
+        commit_timestamp, pipeline_timestamp, pipeline_duration)
+
+@dataclass
+class PendingUpdate:
+    """An upgrade found by a scan but not yet applied"""
+    file_path: str
+    line: int
+    service_key: str
+    current_image_string: str
+    new_image_string: str
+    change: str
+    bump_size: BumpSize
+    discovered_at: float
+
+# patches go first since that is where security fixes usually land, and they are the least likely to break anything
+_PENDING_UPDATE_PRIORITIES = {
+    BumpSize.PATCH: 0,
+    BumpSize.DIGEST: 1,
+    BumpSize.MINOR: 2,
+    BumpSize.MAJOR: 3,
+}
+
 class Broadcaster:
+    # queued behind the log records waiting to be broadcast, so the history is only cleared once they have been pushed
+    CLEAR_HISTORY = logging.makeLogRecord({'msg': 'clear broadcast history'})
+
     def __init__(self):
         self._listeners = set()
         self._lock = threading.Lock()
+        # the current scan's messages, for listeners that join part way through
+        self._history: deque[str] = deque(maxlen=config.log_replay_lines)
+        self._log_queue: queue.SimpleQueue | None = None
 
     def push(self, msg: str):
+        # listeners are called under the lock, so none of them can miss a message or see one twice while replaying
         with self._lock:
-            listeners = list(self._listeners)
-        if not listeners:
-            return
-        for cb in listeners:
-            try:
-                cb(msg)
-            except Exception:
-                pass
+            self._history.append(msg)
+            for cb in self._listeners:
+                try:
+                    cb(msg)
+                except Exception:
+                    pass
 
     def register(self, cb):
         with self._lock:
@@ -50,20 +98,81 @@ class Broadcaster:
         with self._lock:
             self._listeners.discard(cb)
 
+    @contextmanager
+    def replay(self):
+        """Get the history of the current scan, holding back new messages until the caller is done with it"""
+        with self._lock:
+            yield list(self._history)
+
+    def set_log_queue(self, log_queue: queue.SimpleQueue):
+        """Set the queue log records are broadcast from, which history clears are then ordered with"""
+        self._log_queue = log_queue
+
+    def clear_history(self):
+        """Forget the current scan's messages, after the ones logged before this call"""
+        if self._log_queue is not None:
+            self._log_queue.put(self.CLEAR_HISTORY)
+        else:
+            self.drop_history()
+
+    def drop_history(self):
+        with self._lock:
+            self._history.clear()
+
 class State:
     def __init__(self):
         self.db_path = config.db_path
-        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._write_conn = self._connect()
+        self._read_pool: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=config.db_read_pool_size)
         self._init_db()
+        self._skopeo_cache_memory = LruCache(config.skopeo_cache_memory_entries, config.skopeo_cache_memory_bytes)
+        self._skopeo_cache_db_hits = 0
+        # access times of cache hits, written to the skopeo cache table in one batch by maintenance
+        self._skopeo_cache_accesses: dict[tuple[str, ...], float] = {}
+        self._skopeo_cache_accesses_lock = threading.Lock()
+        self.commit_version = 0
+        self._skopeo_cache_db_misses = 0
         self.broadcaster = Broadcaster()
         self.scanner_message_queue = asyncio.Queue()
 
-    def _get_conn(self):
-        return sqlite3.connect(self.db_path, check_same_thread=(not config.is_development))
+    def _connect(self) -> sqlite3.Connection:
+        # connections are long lived so sqlite can reuse its prepared statements between calls
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @contextmanager
+    def _read(self):
+        """Borrow a pooled read connection. With WAL journaling readers never wait on the writer"""
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn.cursor()
+        finally:
+            try:
+                self._read_pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    @contextmanager
+    def _write(self):
+        """Use the single write connection, committing on success and rolling back on error"""
+        with self._write_lock, self._write_conn as conn:
+            yield conn.cursor()
 
     def _init_db(self):
-        with self._get_conn() as conn:
-            c = conn.cursor()
+        with self._write() as c:
+            c.execute('PRAGMA journal_mode=WAL')
+            if c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                # switching to incremental auto vacuum only takes effect after a full vacuum, which rewrites the whole file once
+                _logger.info('Switching the database to incremental auto vacuum, this may take a while for a large database...')
+                start = time.monotonic()
+                c.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                c.execute('VACUUM')
+                _logger.info(f'Switched the database to incremental auto vacuum in {time.monotonic() - start:.1f}s')
             c.execute('''
                 CREATE TABLE IF NOT EXISTS state (
                     key TEXT PRIMARY KEY,
@@ -73,24 +182,121 @@ class State:
             c.execute('''
                 CREATE TABLE IF NOT EXISTS commits (
                     commit_hash TEXT PRIMARY KEY,
-                    data TEXT,
-                    commit_timestamp REAL
+                    commit_short_hash TEXT,
+                    commit_url TEXT,
+                    pipeline_url TEXT,
+                    pipeline_status TEXT,
+                    commit_timestamp REAL,
+                    pipeline_timestamp REAL,
+                    pipeline_duration REAL
+                )
+            ''')
+            if 'data' in self._get_columns(c, 'commits'):
+                self._migrate_commits_data(c)
+            # history pages are read by seeking this index to a cursor, so no page ever scans the rows before it
+            c.execute('CREATE INDEX IF NOT EXISTS commits_timestamp ON commits (commit_timestamp DESC, commit_hash)')
+            # the number of commits is kept up to date by triggers rather than counted on every page
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS row_counts (
+                    table_name TEXT PRIMARY KEY,
+                    row_count INTEGER
                 )
             ''')
+            c.execute("INSERT OR IGNORE INTO row_counts (table_name, row_count) SELECT 'commits', COUNT(*) FROM commits")
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS commits_count_insert AFTER INSERT ON commits BEGIN
+                    UPDATE row_counts SET row_count = row_count + 1 WHERE table_name = 'commits';
+                END
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS commits_count_delete AFTER DELETE ON commits BEGIN
+                    UPDATE row_counts SET row_count = row_count - 1 WHERE table_name = 'commits';
+                END
+            ''')
             c.execute('''
                 CREATE TABLE IF NOT EXISTS skopeo_cache (
                     command_hash TEXT PRIMARY KEY,
                     result TEXT,
-                    timestamp REAL
+                    timestamp REAL,
+                    last_access REAL
                 )
             ''')
-            conn.commit()
-        
+            if 'last_access' not in self._get_columns(c, 'skopeo_cache'):
+                c.execute('ALTER TABLE skopeo_cache ADD COLUMN last_access REAL')
+            c.execute('CREATE INDEX IF NOT EXISTS skopeo_cache_timestamp ON skopeo_cache (timestamp)')
+            c.execute('CREATE INDEX IF NOT EXISTS skopeo_cache_last_access ON skopeo_cache (last_access)')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS pending_updates (
+                    file_path TEXT,
+                    line INTEGER,
+                    service_key TEXT,
+                    current_image_string TEXT,
+                    new_image_string TEXT,
+                    change TEXT,
+                    bump_size INTEGER,
+                    priority INTEGER,
+                    discovered_at REAL,
+                    refreshed_at REAL,
+                    PRIMARY KEY (file_path, line)
+                )
+            ''')
+            if 'refreshed_at' not in self._get_columns(c, 'pending_updates'):
+                c.execute('ALTER TABLE pending_updates ADD COLUMN refreshed_at REAL')
+                c.execute('UPDATE pending_updates SET refreshed_at = discovered_at')
+            c.execute('CREATE INDEX IF NOT EXISTS pending_updates_priority ON pending_updates (priority, discovered_at)')
+            c.execute('CREATE INDEX IF NOT EXISTS pending_updates_refreshed_at ON pending_updates (refreshed_at)')
+            # replaced by resolved_candidates, which also remembers the version the digest was resolved for
+            c.execute('DROP TABLE IF EXISTS resolved_digests')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS resolved_candidates (
+                    lookup_key TEXT PRIMARY KEY,
+                    candidate_version INTEGER,
+                    digest TEXT,
+                    versions_fingerprint TEXT,
+                    resolved_at REAL
+                )
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS resolved_candidates_resolved_at ON resolved_candidates (resolved_at)')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS compose_parse_cache (
+                    file_path TEXT PRIMARY KEY,
+                    content_key TEXT,
+                    data TEXT
+                )
+            ''')
+
+    def _migrate_commits_data(self, c: sqlite3.Cursor):
+        """Move commits from the json data column into their own columns"""
+        columns = self._get_columns(c, 'commits')
+        for column, column_type in _COMMIT_COLUMN_TYPES.items():
+            if column not in columns:
+                c.execute(f'ALTER TABLE commits ADD COLUMN {column} {column_type}')
+        c.execute('''
+            UPDATE commits SET
+                commit_short_hash = json_extract(data, '$.commit_short_hash'),
+                commit_url = json_extract(data, '$.commit_url'),
+                pipeline_url = json_extract(data, '$.pipeline_url'),
+                pipeline_status = json_extract(data, '$.pipeline_status'),
+                commit_timestamp = COALESCE(commit_timestamp, json_extract(data, '$.commit_timestamp'), 0),
+                pipeline_timestamp = json_extract(data, '$.pipeline_timestamp'),
+                pipeline_duration = json_extract(data, '$.pipeline_duration')
+            WHERE data IS NOT NULL
+        ''')
+        c.execute('ALTER TABLE commits DROP COLUMN data')
+
+    @staticmethod
+    def _get_columns(c: sqlite3.Cursor, table: str) -> list[str]:
+        return [row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()]
+
+    def incremental_vacuum(self, pages: int):
+        """Return up to the given number of free pages to the file system"""
+        with self._write_lock:
+            # executescript steps the pragma to completion, execute would only free a single page
+            self._write_conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
 
     @property
     def next_run(self) -> float | None:
-        with self._lock, self._get_conn() as conn:
-            c = conn.cursor()
+        with self._read() as c:
             c.execute('SELECT value FROM state WHERE key = ?', ('next_run',))
             row = c.fetchone()
             if row:
@@ -99,89 +305,106 @@ class State:
 
     @next_run.setter
     def next_run(self, value: float | None):
-        with self._lock, self._get_conn() as conn:
-            c = conn.cursor()
+        with self._write() as c:
             if value is None:
                 c.execute('DELETE FROM state WHERE key = ?', ('next_run',))
             else:
                 c.execute('REPLACE INTO state (key, value) VALUES (?, ?)', ('next_run', str(value)))
-            conn.commit()
 
     class CommitDict:
         def __init__(self, state):
             self.state = state
 
+        @property
+        def version(self) -> int:
+            """Bumped on every write, so anything rendered from the history can tell when it is stale"""
+            return self.state.commit_version
+
         def __contains__(self, commit_hash: str) -> bool:
-            return self.__getitem__(commit_hash) is not None
+            with self.state._read() as c:
+                return c.execute('SELECT 1 FROM commits WHERE commit_hash = ?', (commit_hash,)).fetchone() is not None
 
         def __getitem__(self, commit_hash: str) -> CommitInfo | None:
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
-                c.execute('SELECT data, commit_timestamp FROM commits WHERE commit_hash = ?', (commit_hash,))
-                row = c.fetchone()
-                if row:
-                    data = json.loads(row[0])
-                    # Convert pipeline_status back to enum
-                    data['pipeline_status'] = PipelineStatus(data['pipeline_status'])
-                    # Use the dedicated timestamp column if available, otherwise fall back to JSON data
-                    if row[1] is not None:
-                        data['commit_timestamp'] = row[1]
-                    return CommitInfo(**data)
-                return None
+            with self.state._read() as c:
+                row = c.execute(f'SELECT {_COMMIT_COLUMNS} FROM commits WHERE commit_hash = ?', (commit_hash,)).fetchone()
+                return _commit_from_row(row) if row else None
 
         def __setitem__(self, commit_hash: str, value: CommitInfo):
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
-                data = asdict(value)
-                # Store pipeline_status as string
-                data['pipeline_status'] = data['pipeline_status'].value
-                c.execute('REPLACE INTO commits (commit_hash, data, commit_timestamp) VALUES (?, ?, ?)', 
-                         (commit_hash, json.dumps(data), value.commit_timestamp))
-                conn.commit()
+            with self.state._write() as c:
+                # an upsert rather than REPLACE, which deletes without firing the delete trigger and so breaks the row count
+                c.execute(f'''
+                    INSERT INTO commits ({_COMMIT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (commit_hash) DO UPDATE SET
+                        commit_short_hash = excluded.commit_short_hash,
+                        commit_url = excluded.commit_url,
+                        pipeline_url = excluded.pipeline_url,
+                        pipeline_status = excluded.pipeline_status,
+                        commit_timestamp = excluded.commit_timestamp,
+                        pipeline_timestamp = excluded.pipeline_timestamp,
+                        pipeline_duration = excluded.pipeline_duration
+                ''', (commit_hash, value.commit_short_hash, value.commit_url, value.pipeline_url, value.pipeline_status.value,
+                      value.commit_timestamp, value.pipeline_timestamp, value.pipeline_duration))
+            self.state.commit_version += 1
+
+        def set_pipeline(self, commit_hash: str, pipeline_status: PipelineStatus, commit_url: str | None,
+                pipeline_url: str | None, pipeline_timestamp: float, pipeline_duration: float | None) -> bool:
+            """Record the outcome of a commit's pipeline, returning False if the commit is not known"""
+            with self.state._write() as c:
+                c.execute('''
+                    UPDATE commits
+                    SET pipeline_status = ?, commit_url = ?, pipeline_url = ?, pipeline_timestamp = ?, pipeline_duration = ?
+                    WHERE commit_hash = ?
+                ''', (pipeline_status.value, commit_url, pipeline_url, pipeline_timestamp, pipeline_duration, commit_hash))
+                updated = c.rowcount > 0
+            if updated:
+                self.state.commit_version += 1
+            return updated
 
         def __delitem__(self, commit_hash: str):
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
+            with self.state._write() as c:
                 c.execute('DELETE FROM commits WHERE commit_hash = ?', (commit_hash,))
-                conn.commit()
+            self.state.commit_version += 1
 
         def get(self, commit_hash: str, default=None) -> CommitInfo | None:
             result = self.__getitem__(commit_hash)
             return result if result is not None else default
 
-        def items(self, page: int = 1, per_page: int = 20) -> tuple[list[tuple[str, CommitInfo]], int]:
-            """Get paginated commits as (commit_hash, CommitInfo) pairs and total count"""
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
-                
-                # Get total count
-                c.execute('SELECT COUNT(*) FROM commits')
-                total_count = c.fetchone()[0]
-                
-                # Calculate offset
-                offset = (page - 1) * per_page
-                
-                # Get paginated results
-                c.execute('''
-                    SELECT commit_hash, data, commit_timestamp 
-                    FROM commits 
-                    ORDER BY commit_timestamp DESC, commit_hash 
-                    LIMIT ? OFFSET ?
-                ''', (per_page, offset))
-                
+        def __len__(self) -> int:
+            with self.state._read() as c:
+                row = c.execute("SELECT row_count FROM row_counts WHERE table_name = 'commits'").fetchone()
+                return row[0] if row else 0
+
+        def items(self, per_page: int = 20, cursor: tuple[float, str] | None = None, newer: bool = False) -> tuple[list[tuple[str, CommitInfo]], bool]:
+            """Get a page of commits, newest first, as (commit_hash, CommitInfo) pairs and whether there are more beyond it.
+            Pages are taken from a (commit_timestamp, commit_hash) cursor, going to older commits or to newer ones if newer is set.
+            Without a cursor this is the newest page, or the oldest page if newer is set"""
+            if newer:
+                where = 'WHERE commit_timestamp >= ? AND (commit_timestamp > ? OR commit_hash < ?)'
+                order = 'ORDER BY commit_timestamp ASC, commit_hash DESC'
+            else:
+                where = 'WHERE commit_timestamp <= ? AND (commit_timestamp < ? OR commit_hash > ?)'
+                order = 'ORDER BY commit_timestamp DESC, commit_hash'
+            if cursor is None:
+                where, params = '', ()
+            else:
+                params = (cursor[0], cursor[0], cursor[1])
+
+            with self.state._read() as c:
+                # one extra row tells whether there is another page
+                c.execute(f'''
+                    SELECT {_COMMIT_COLUMNS}
+                    FROM commits
+                    {where}
+                    {order}
+                    LIMIT ?
+                ''', (*params, per_page + 1))
                 rows = c.fetchall()
-                items = []
-                for commit_hash, data, commit_timestamp in rows:
-                    data_dict = json.loads(data)
-                    # Convert pipeline_status back to enum
-                    data_dict['pipeline_status'] = PipelineStatus(data_dict['pipeline_status'])
-                    # Use the dedicated timestamp column if available, otherwise fall back to JSON data
-                    if commit_timestamp is not None:
-                        data_dict['commit_timestamp'] = commit_timestamp
-                    commit_info = CommitInfo(**data_dict)
-                    items.append((commit_hash, commit_info))
-                
-                return items, total_count
+
+            has_more = len(rows) > per_page
+            rows = rows[:per_page]
+            if newer:
+                rows.reverse()
+            return [(row[0], _commit_from_row(row)) for row in rows], has_more
 
     class SkopeoCacheDict:
         def __init__(self, state):
@@ -194,26 +417,60 @@ class State:
             command_str = f"{command}:{':'.join(args)}"
             return hashlib.sha256(command_str.encode()).hexdigest()
 
+        def _is_fresh(self, expiration_time: float, current_time: float) -> bool:
+            max_expiration = current_time + (config.skopeo_cache_duration * (1.0 + config.skopeo_cache_variance))
+            return current_time < expiration_time and expiration_time <= max_expiration
+
         def get(self, command: str, args: list[str]) -> str | None:
             """Get cached result for a skopeo command, returns None if not found or expired"""
-            command_hash = self._hash_command(command, args)
+            memory_key = (command, *args)
             current_time = time.time()
-            
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
+
+            cached = self.state._skopeo_cache_memory.get(memory_key)
+            if cached is not None:
+                result, expiration_time = cached
+                if self._is_fresh(expiration_time, current_time):
+                    self._record_access(memory_key, current_time)
+                    return result
+                self.state._skopeo_cache_memory.pop(memory_key)
+
+            command_hash = self._hash_command(command, args)
+            with self.state._read() as c:
                 c.execute('SELECT result, timestamp FROM skopeo_cache WHERE command_hash = ?', (command_hash,))
                 row = c.fetchone()
-                
-                if row:
-                    result, expiration_time = row
-                    max_expiration = current_time + (config.skopeo_cache_duration * (1.0 + config.skopeo_cache_variance))
-                    if current_time < expiration_time and expiration_time <= max_expiration:
-                        return result
-                    else:
+
+            if row:
+                result, expiration_time = row
+                if self._is_fresh(expiration_time, current_time):
+                    self.state._skopeo_cache_db_hits += 1
+                    self._remember(memory_key, result, expiration_time)
+                    self._record_access(memory_key, current_time)
+                    return result
+                else:
+                    with self.state._write() as c:
                         c.execute('DELETE FROM skopeo_cache WHERE command_hash = ?', (command_hash,))
-                        conn.commit()
-                        return None
-                return None
+            self.state._skopeo_cache_db_misses += 1
+            return None
+
+        def _record_access(self, memory_key: tuple[str, ...], current_time: float):
+            with self.state._skopeo_cache_accesses_lock:
+                self.state._skopeo_cache_accesses[memory_key] = current_time
+
+        def flush_access_times(self) -> int:
+            """Write the access times of the hits since the last flush, so eviction sees which entries are in use"""
+            with self.state._skopeo_cache_accesses_lock:
+                accesses = self.state._skopeo_cache_accesses
+                self.state._skopeo_cache_accesses = {}
+            if not accesses:
+                return 0
+            with self.state._write() as c:
+                c.executemany('UPDATE skopeo_cache SET last_access = ? WHERE command_hash = ?',
+                    [(access_time, self._hash_command(key[0], list(key[1:]))) for key, access_time in accesses.items()])
+            return len(accesses)
+
+        def _remember(self, memory_key: tuple[str, ...], result: str, expiration_time: float):
+            size_bytes = encoded_size(result) + sum(map(encoded_size, memory_key))
+            self.state._skopeo_cache_memory.set(memory_key, (result, expiration_time), size_bytes)
 
         def set(self, command: str, args: list[str], result: str):
             """Cache the result of a skopeo command"""
@@ -223,23 +480,193 @@ class State:
             variance_factor = 1.0 + random.uniform(-config.skopeo_cache_variance, config.skopeo_cache_variance)
             cache_duration = config.skopeo_cache_duration * variance_factor
 
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
-                expiration_time = current_time + cache_duration
-                c.execute('REPLACE INTO skopeo_cache (command_hash, result, timestamp) VALUES (?, ?, ?)', 
-                         (command_hash, result, expiration_time))
-                conn.commit()
+            expiration_time = current_time + cache_duration
+            self._remember((command, *args), result, expiration_time)
+            with self.state._write() as c:
+                c.execute('REPLACE INTO skopeo_cache (command_hash, result, timestamp, last_access) VALUES (?, ?, ?, ?)', 
+                         (command_hash, result, expiration_time, current_time))
 
-        def cleanup_expired(self):
-            """Remove all expired cache entries and entries beyond current max duration"""
+        def stats(self) -> dict[str, dict[str, int]]:
+            """Hit and miss counters for each cache tier"""
+            memory = self.state._skopeo_cache_memory
+            return {
+                'memory': {
+                    'hits': memory.hits,
+                    'misses': memory.misses,
+                    'evictions': memory.evictions,
+                    'entries': len(memory),
+                    'bytes': memory.size_bytes,
+                },
+                'sqlite': {
+                    'hits': self.state._skopeo_cache_db_hits,
+                    'misses': self.state._skopeo_cache_db_misses,
+                }
+            }
+
+        def cleanup_expired(self, batch_size: int = 500) -> int:
+            """Remove all expired cache entries and entries beyond current max duration, in batches so other writers are not held up"""
             current_time = time.time()
-            max_expiration = current_time + config.skopeo_cache_duration
-            
-            with self.state._lock, self.state._get_conn() as conn:
-                c = conn.cursor()
-                c.execute('DELETE FROM skopeo_cache WHERE timestamp < ? OR timestamp > ?', 
-                         (current_time, max_expiration))
-                conn.commit()
+            max_expiration = current_time + (config.skopeo_cache_duration * (1.0 + config.skopeo_cache_variance))
+
+            removed = 0
+            while True:
+                with self.state._write() as c:
+                    c.execute('''
+                        DELETE FROM skopeo_cache WHERE rowid IN (
+                            SELECT rowid FROM skopeo_cache WHERE timestamp < ? OR timestamp > ? LIMIT ?
+                        )
+                    ''', (current_time, max_expiration, batch_size))
+                    removed += c.rowcount
+                if c.rowcount < batch_size:
+                    return removed
+
+        def enforce_size_limit(self, max_bytes: int, batch_size: int = 500) -> int:
+            """Evict the least recently used entries until the cached results fit in max_bytes"""
+            with self.state._read() as c:
+                c.execute('SELECT COALESCE(SUM(LENGTH(CAST(result AS BLOB))), 0) FROM skopeo_cache')
+                total_bytes = c.fetchone()[0]
+
+            removed = 0
+            while total_bytes > max_bytes:
+                with self.state._write() as c:
+                    c.execute('''
+                        SELECT rowid, LENGTH(CAST(result AS BLOB)) FROM skopeo_cache
+                        ORDER BY last_access
+                        LIMIT ?
+                    ''', (batch_size,))
+                    rows = c.fetchall()
+                    if not rows:
+                        break
+                    evicted = []
+                    for rowid, size in rows:
+                        if total_bytes <= max_bytes:
+                            break
+                        evicted.append((rowid,))
+                        total_bytes -= size or 0
+                    c.executemany('DELETE FROM skopeo_cache WHERE rowid = ?', evicted)
+                    removed += len(evicted)
+            return removed
+
+    class PendingUpdateQueue:
+        """Upgrades waiting to be applied, taken highest priority first and oldest first within a priority"""
+        def __init__(self, state):
+            self.state = state
+
+        def __len__(self) -> int:
+            with self.state._read() as c:
+                c.execute('SELECT COUNT(*) FROM pending_updates')
+                return c.fetchone()[0]
+
+        def keys(self) -> set[tuple[str, int]]:
+            """Get the (file path, line) of every queued upgrade"""
+            with self.state._read() as c:
+                c.execute('SELECT file_path, line FROM pending_updates')
+                return {(file_path, line) for file_path, line in c.fetchall()}
+
+        def add(self, updates: list[PendingUpdate]):
+            """Queue upgrades. An upgrade to a line that is already queued replaces it, but keeps its place in the queue
+            and counts as found again for expiry"""
+            with self.state._write() as c:
+                c.executemany('''
+                    INSERT INTO pending_updates (file_path, line, service_key, current_image_string, new_image_string, change, bump_size, priority, discovered_at, refreshed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (file_path, line) DO UPDATE SET
+                        service_key = excluded.service_key,
+                        current_image_string = excluded.current_image_string,
+                        new_image_string = excluded.new_image_string,
+                        change = excluded.change,
+                        bump_size = excluded.bump_size,
+                        priority = excluded.priority,
+                        refreshed_at = excluded.refreshed_at
+                ''', [(u.file_path, u.line, u.service_key, u.current_image_string, u.new_image_string, u.change,
+                       int(u.bump_size), _PENDING_UPDATE_PRIORITIES[u.bump_size], u.discovered_at, u.discovered_at) for u in updates])
+
+        def peek(self, limit: int, offset: int = 0) -> list[PendingUpdate]:
+            """Get the next upgrades to apply without removing them"""
+            with self.state._read() as c:
+                c.execute('''
+                    SELECT file_path, line, service_key, current_image_string, new_image_string, change, bump_size, discovered_at
+                    FROM pending_updates
+                    ORDER BY priority, discovered_at
+                    LIMIT ? OFFSET ?
+                ''', (limit, offset))
+                return [PendingUpdate(file_path, line, service_key, current_image_string, new_image_string, change, BumpSize(bump_size), discovered_at)
+                        for file_path, line, service_key, current_image_string, new_image_string, change, bump_size, discovered_at in c.fetchall()]
+
+        def remove(self, updates: list[PendingUpdate]):
+            with self.state._write() as c:
+                c.executemany('DELETE FROM pending_updates WHERE file_path = ? AND line = ?', [(u.file_path, u.line) for u in updates])
+
+        def remove_expired(self, max_age: float) -> int:
+            """Remove upgrades last found more than max_age seconds ago, since a newer version may have been released since"""
+            with self.state._write() as c:
+                c.execute('DELETE FROM pending_updates WHERE refreshed_at < ?', (time.time() - max_age,))
+                return c.rowcount
+
+        def trim(self, limit: int) -> int:
+            """Drop the lowest priority upgrades until at most limit are queued"""
+            with self.state._write() as c:
+                c.execute('''
+                    DELETE FROM pending_updates WHERE rowid IN (
+                        SELECT rowid FROM pending_updates ORDER BY priority, discovered_at LIMIT -1 OFFSET ?
+                    )
+                ''', (max(0, limit),))
+                return c.rowcount
+
+    class ResolvedCandidateDict:
+        """The upgrade last chosen for each image version and bump size, as a packed version and its digest,
+        along with the fingerprint of the versions it was chosen from"""
+        def __init__(self, state):
+            self.state = state
+
+        def get(self, lookup_key: str, versions_fingerprint: str, max_age: float) -> tuple[int, str] | None:
+            """Get the packed version and digest chosen last time, returns None if the versions have changed or it is older than max_age seconds"""
+            with self.state._read() as c:
+                c.execute('''
+                    SELECT candidate_version, digest FROM resolved_candidates
+                    WHERE lookup_key = ? AND versions_fingerprint = ? AND resolved_at >= ?
+                ''', (lookup_key, versions_fingerprint, time.time() - max_age))
+                row = c.fetchone()
+            return (row[0], row[1]) if row else None
+
+        def set(self, lookup_key: str, versions_fingerprint: str, candidate_version: int, digest: str):
+            with self.state._write() as c:
+                c.execute('''
+                    REPLACE INTO resolved_candidates (lookup_key, candidate_version, digest, versions_fingerprint, resolved_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (lookup_key, candidate_version, digest, versions_fingerprint, time.time()))
+
+        def cleanup_expired(self, max_age: float) -> int:
+            with self.state._write() as c:
+                c.execute('DELETE FROM resolved_candidates WHERE resolved_at < ?', (time.time() - max_age,))
+                return c.rowcount
+
+    class ComposeParseCacheDict:
+        def __init__(self, state):
+            self.state = state
+
+        def get(self, file_path: str, content_key: str) -> str | None:
+            """Get the cached parse of a file, returns None if the file has changed since it was cached"""
+            with self.state._read() as c:
+                c.execute('SELECT data FROM compose_parse_cache WHERE file_path = ? AND content_key = ?', (file_path, content_key))
+                row = c.fetchone()
+            return row[0] if row else None
+
+        def set(self, file_path: str, content_key: str, data: str):
+            """Cache the parse of a file, replacing any parse of an older version of it"""
+            with self.state._write() as c:
+                c.execute('REPLACE INTO compose_parse_cache (file_path, content_key, data) VALUES (?, ?, ?)',
+                         (file_path, content_key, data))
+
+        def retain(self, file_paths: Container[str]) -> int:
+            """Remove the cached parses of every file not in file_paths"""
+            with self.state._read() as c:
+                c.execute('SELECT file_path FROM compose_parse_cache')
+                removed = [(row[0],) for row in c.fetchall() if row[0] not in file_paths]
+            if removed:
+                with self.state._write() as c:
+                    c.executemany('DELETE FROM compose_parse_cache WHERE file_path = ?', removed)
+            return len(removed)
 
     @property
     def commit(self) -> 'State.CommitDict':
@@ -249,4 +676,16 @@ class State:
     def skopeo_cache(self) -> 'State.SkopeoCacheDict':
         return self.SkopeoCacheDict(self)
 
+    @property
+    def pending_updates(self) -> 'State.PendingUpdateQueue':
+        return self.PendingUpdateQueue(self)
+
+    @property
+    def resolved_candidates(self) -> 'State.ResolvedCandidateDict':
+        return self.ResolvedCandidateDict(self)
+
+    @property
+    def compose_parse_cache(self) -> 'State.ComposeParseCacheDict':
+        return self.ComposeParseCacheDict(self)
+
 state = State()
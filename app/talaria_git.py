@@ -49,6 +49,12 @@ class TalariaGit:
             shutil.rmtree(self.repo_path)
             _logger.info(f"Deleted repository at {self.repo_path}")
 
+    def _get_clone_url(self) -> str:
+        # Use authenticated URL if token is present
+        if self.auth_token:
+            return self.repo_url.replace('https://', f'https://oauth2:{self.auth_token}@')
+        return self.repo_url
+
     async def clone(self):
         if self.repo_path.exists():
             _logger.warning(f"Repository already exists at {self.repo_path}")
@@ -57,15 +63,68 @@ class TalariaGit:
         # Create parent directory if it doesn't exist
         self.repo_path.mkdir(parents=True, exist_ok=True)
         
-        # Use authenticated URL if token is present
-        clone_url = self.repo_url
-        if self.auth_token:
-            clone_url = self.repo_url.replace('https://', f'https://oauth2:{self.auth_token}@')
-        
+        if config.git_sparse_checkout:
+            # Partial clone without any blobs, then only check out the files that could be compose files
+            await self._run_git('clone', '--depth', '1', '--filter=blob:none', '--no-checkout', '--branch', self.branch, self._get_clone_url(), str(self.repo_path))
+            await self._set_sparse_checkout()
+            await self._run_git('checkout', self.branch)
+            _logger.info(f"Cloned repository to {self.repo_path} with sparse checkout")
+            return
+
         # Clone with depth=1 for shallow clone
-        await self._run_git('clone', '--depth', '1', '--branch', self.branch, clone_url, str(self.repo_path))
+        await self._run_git('clone', '--depth', '1', '--branch', self.branch, self._get_clone_url(), str(self.repo_path))
         _logger.info(f"Cloned repository to {self.repo_path}")
 
+    def _get_sparse_checkout_patterns(self) -> list[str]:
+        """Convert the compose file glob into sparse checkout patterns that match it at any depth, like rglob does"""
+        pattern = config.docker_compose_file_pattern.strip('/')
+        if '/' in pattern:
+            return [f'**/{pattern}']
+        return [pattern]
+
+    async def _set_sparse_checkout(self):
+        await self._run_git('sparse-checkout', 'set', '--no-cone', *self._get_sparse_checkout_patterns())
+
+    async def _can_reuse(self) -> bool:
+        """Check that the existing repository is intact and points at the configured remote and branch"""
+        if not (self.repo_path / '.git').exists():
+            return False
+        try:
+            remote_url = await self._run_git('remote', 'get-url', 'origin')
+            branch = await self._run_git('rev-parse', '--abbrev-ref', 'HEAD')
+            is_sparse = await self._run_git('config', '--bool', '--default', 'false', 'core.sparseCheckout') == 'true'
+        except subprocess.CalledProcessError:
+            _logger.warning(f"Existing repository at {self.repo_path} is not usable")
+            return False
+        if remote_url != self._get_clone_url():
+            _logger.info("Configured remote has changed since the repository was cloned")
+            return False
+        if branch != self.branch:
+            _logger.info(f"Configured branch has changed from {branch} to {self.branch} since the repository was cloned")
+            return False
+        if is_sparse != config.git_sparse_checkout:
+            _logger.info("Configured sparse checkout mode has changed since the repository was cloned")
+            return False
+        return True
+
+    async def sync(self):
+        """Bring the repository in line with the remote branch, only recloning if the existing one cannot be reused"""
+        if config.git_persistent_workspace and await self._can_reuse():
+            try:
+                await self._run_git('fetch', '--depth', '1', 'origin', self.branch)
+                if config.git_sparse_checkout:
+                    # the compose file pattern may have changed since the last scan
+                    await self._set_sparse_checkout()
+                await self._run_git('reset', '--hard', f'origin/{self.branch}')
+                await self._run_git('clean', '-fdx')
+                _logger.info(f"Updated repository at {self.repo_path}")
+                return
+            except subprocess.CalledProcessError:
+                _logger.warning(f"Failed to update repository at {self.repo_path}, recloning")
+
+        self.delete()
+        await self.clone()
+
     async def add(self, files=None):
         """Stage changes. If files is None, stage all changes"""
         if files is None:
@@ -97,6 +156,17 @@ class TalariaGit:
         """Get the short commit hash"""
         return await self._run_git('rev-parse', '--short', 'HEAD')
 
+    async def get_file_hashes(self) -> dict[str, str]:
+        """Get the git blob sha of every tracked file, keyed by absolute path. Files modified in the working tree are left out"""
+        modified = set((await self._run_git('diff', '--name-only', '-z')).split('\0'))
+        hashes = {}
+        for entry in (await self._run_git('ls-files', '--stage', '-z')).split('\0'):
+            # <mode> <blob sha> <stage>\t<path>
+            info, sep, path = entry.partition('\t')
+            if sep and path not in modified:
+                hashes[str(self.repo_path / path)] = info.split(' ')[1]
+        return hashes
+
     async def setup_auth(self):
         """Setup authentication for the repository"""
         if not self.auth_token: